@@ -2,7 +2,7 @@
 Django settings for WordTree project.
 """
 
-from os import path, sys
+from os import environ, path, sys
 PROJECT_ROOT = path.dirname(path.abspath(path.dirname(__file__)))
 
 MY_DEBUGGING_ = True
@@ -30,6 +30,20 @@ DATABASES = {
     }
 }
 
+# Use PostgreSQL (with psycopg2 installed) when WORDTREE_DB_NAME is set, e.g.
+#   WORDTREE_DB_NAME=wordtree WORDTREE_DB_USER=wordtree python manage.py test app
+# The server must provide the ltree extension: subtree queries then use the
+# GiST indexed ltree copy of Submenu.path added by migration 0012.
+if environ.get('WORDTREE_DB_NAME'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': environ['WORDTREE_DB_NAME'],
+        'USER': environ.get('WORDTREE_DB_USER', ''),
+        'PASSWORD': environ.get('WORDTREE_DB_PASSWORD', ''),
+        'HOST': environ.get('WORDTREE_DB_HOST', ''),
+        'PORT': environ.get('WORDTREE_DB_PORT', ''),
+    }
+
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/menu/1/'
 
@@ -119,6 +133,7 @@ TEMPLATES = [
 ]
 
 MIDDLEWARE_CLASSES = (
+    'app.middleware.QueryBudgetMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -187,6 +202,45 @@ LOGGING = {
     }
 }
 
+# Spacing between the ordinals of sibling menu items.
+# 1 keeps them dense (1..N). A large gap such as 1024 lets insert, move and
+# delete change only the one row that moves; siblings are respaced only
+# when the room between two ordinals runs out.
+MENU_ORDINAL_GAP = 1
+
+# Number of children listed per page of a menu.
+MENU_PAGE_SIZE = 100
+
+# Keep an in-memory replica of the menu tree in each worker process.
+# Workers learn of changes through a generation counter in the default cache,
+# so configure a shared cache backend before enabling this with several workers.
+TREE_REPLICA = False
+
+# Assemble menu_get responses from cached JSON fragments of unchanged subtrees.
+# Reads that miss write the fragments, so this is off by default.
+TREE_JSON_CACHE = False
+
+# Path of a binary snapshot of the menu tree, written by the write_snapshot
+# command and memory-mapped by every worker. None disables the snapshot.
+# Workers look for a newly written file every TREE_SNAPSHOT_CHECK_INTERVAL
+# seconds, and learn of changes to the tree as the replica does.
+TREE_SNAPSHOT = None
+TREE_SNAPSHOT_CHECK_INTERVAL = 1
+
+# Bearer tokens for the JSON API (see app.tokens and the issue_token command).
+# Tokens last API_TOKEN_MAX_AGE seconds unless issued for longer or shorter.
+# Bump API_TOKEN_KEY_VERSION to revoke every token. Revoking one user's tokens
+# takes effect within API_TOKEN_CHECK_INTERVAL seconds.
+API_TOKEN_MAX_AGE = 24 * 60 * 60
+API_TOKEN_KEY_VERSION = 1
+API_TOKEN_CHECK_INTERVAL = 60
+
+# Per-request SQL query budgets. A warning is logged when a view runs more
+# queries than its budget in QUERY_BUDGETS, keyed by the view's dotted name,
+# or else QUERY_BUDGET. None means no limit.
+QUERY_BUDGET = None
+QUERY_BUDGETS = {}
+
 # Specify the default test runner.
 TEST_RUNNER = 'django.test.runner.DiscoverRunner'
 
@@ -54,8 +54,17 @@ urlpatterns = [
     url(r'^menu/(?P<menu>(\d+/)+)change_parent/$', change_parent, name='change_parent'),
 
     # API URLs
+    url(r'^api/search/$', api.menu_search, name='api_menu_search'),
+    url(r'^api/changes/$', api.menu_changes, name='api_menu_changes'),
+    url(r'^api/batch/$', api.menu_batch, name='api_menu_batch'),
     url(r'^api/(?P<menu>(\d+/)+)add/', api.menu_add, name='api_menu_add'),
     url(r'^api/(?P<menu>(\d+/)+)get/', api.menu_get, name='api_menu_get'),
+    url(r'^api/(?P<menu>(\d+/)+)bulk_add/', api.menu_bulk_add, name='api_menu_bulk_add'),
+    url(r'^api/(?P<menu>(\d+/)+)children/', api.menu_children, name='api_menu_children'),
+    url(r'^api/(?P<menu>(\d+/)+)change_parent/', api.menu_change_parent, name='api_menu_change_parent'),
+    url(r'^api/(?P<menu>(\d+/)+)reorder/', api.menu_reorder, name='api_menu_reorder'),
+    url(r'^api/(?P<menu>(\d+/)+)export/', api.menu_export, name='api_menu_export'),
+    url(r'^api/(?P<menu>(\d+/)+)import/', api.menu_import, name='api_menu_import'),
 
     # Uncomment the admin/doc line below to enable admin documentation:
     url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
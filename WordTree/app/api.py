@@ -2,18 +2,24 @@
 Definition of API.
 """
 
-from django.contrib.auth.decorators import login_required, permission_required
 from django.shortcuts import redirect
-from django.http import HttpRequest, Http404, JsonResponse
+from django.http import HttpRequest, Http404, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import condition
 
+import json
 import logging
 
+from app.models import Menu, Submenu
 import app.api_impl
+import app.batch
+import app.journal
+import app.search
+import app.transfer
+from app.tokens import api_auth
 
 logger = logging.getLogger(__name__)
 
-@login_required
-@permission_required(['app.add_menu', 'app.add_submenu'])
+@api_auth('app.add_menu', 'app.add_submenu')
 def menu_add(request, menu):
     """
     URL=/api/id1/id2.../add?name=new_name
@@ -27,22 +33,308 @@ def menu_add(request, menu):
 
         menupath = menu.split("/")[0:-1] if menu else ['1']
 
-        return app.api_impl.menu_add(menupath[-1], new_name)
+        try:
+            return app.api_impl.menu_add(menupath[-1], new_name)
+        except app.api_impl.MenuTreeError as e:
+            return JsonResponse({ 'error': str(e) }, status=400)
     else:
         return redirect('/menu/{0}/'.format(menu))
 
-@login_required
+@api_auth('app.add_menu', 'app.add_submenu')
+def menu_bulk_add(request, menu):
+    """
+    URL=/api/id1/id2.../bulk_add/
+    The POST body is a JSON list of new items, each either a name
+    or a nested item, e.g. ["A", {"name": "B", "submenu": ["B1", "B2"]}]
+    API returns JSON response containing the new ids in pre-order.
+    e.g. { 'ids': [2, 3, 4, 5] }
+    """
+    if request.method == 'POST':
+        logger.info("api.menu_bulk_add('{0}', menu='{1}')".format(request.get_raw_uri(), menu))
+
+        menupath = menu.split("/")[0:-1] if menu else ['1']
+
+        try:
+            items = json.loads(request.body.decode('utf-8'))
+            return JsonResponse({ 'ids': app.api_impl.menu_bulk_add(menupath[-1], items) })
+        except ValueError:
+            return JsonResponse({ 'error': 'Invalid JSON' }, status=400)
+        except app.api_impl.MenuTreeError as e:
+            return JsonResponse({ 'error': str(e) }, status=400)
+        except Menu.DoesNotExist:
+            raise Http404("Invalid menu: '{0}'".format(menu))
+    else:
+        return redirect('/menu/{0}/'.format(menu))
+
+@api_auth('app.change_submenu')
+def menu_change_parent(request, menu):
+    """
+    URL=/api/id1/id2.../change_parent/?parent=new_parent_id
+    Moves the menu, with all its descendants, to the end of the new parent's children.
+    API returns JSON response containing the menu's new path.
+    e.g. { 'id': 42, 'parent': 5, 'path': '/1/5/42/' }
+    """
+    if request.method == 'POST':
+        parentid = request.GET.get('parent')
+        logger.info("api.menu_change_parent('{0}', menu='{1}', parent='{2}')".format(request.get_raw_uri(), menu, parentid))
+
+        menupath = menu.split("/")[0:-1] if menu else ['1']
+
+        try:
+            path = app.api_impl.change_parent(menupath[-1], parentid)
+            return JsonResponse({ 'id': int(menupath[-1]), 'parent': int(parentid), 'path': path })
+        except (TypeError, ValueError):
+            return JsonResponse({ 'error': 'Invalid parent' }, status=400)
+        except app.api_impl.MenuTreeError as e:
+            return JsonResponse({ 'error': str(e) }, status=400)
+        except (Menu.DoesNotExist, Submenu.DoesNotExist):
+            raise Http404("Invalid menu: '{0}'".format(menu))
+    else:
+        return redirect('/menu/{0}/'.format(menu))
+
+@api_auth('app.change_submenu')
+def menu_reorder(request, menu):
+    """
+    URL=/api/id1/id2.../reorder/
+    The POST body is a JSON list of the ids of all of the menu's children
+    in their new order, e.g. [42, 40, 41].
+    API returns JSON response containing the children's new ordinals.
+    e.g. { 'id': 5, 'children': [[42, 1], [40, 2], [41, 3]] }
+    """
+    if request.method == 'POST':
+        logger.info("api.menu_reorder('{0}', menu='{1}')".format(request.get_raw_uri(), menu))
+
+        menupath = menu.split("/")[0:-1] if menu else ['1']
+        if not Menu.objects.filter(id=int(menupath[-1])).exists():
+            raise Http404("Invalid menu: '{0}'".format(menu))
+
+        try:
+            childids = json.loads(request.body.decode('utf-8'))
+            if not isinstance(childids, list):
+                raise ValueError(childids)
+            ordinals = app.api_impl.reorder_children(menupath[-1], childids)
+            return JsonResponse({ 'id': int(menupath[-1]), 'children': [list(pair) for pair in ordinals] })
+        except (TypeError, ValueError):
+            return JsonResponse({ 'error': 'Invalid JSON' }, status=400)
+        except app.api_impl.MenuTreeError as e:
+            return JsonResponse({ 'error': str(e) }, status=400)
+    else:
+        return redirect('/menu/{0}/'.format(menu))
+
+def menu_validator(request, menu):
+    """
+    The (version, modified) pair of the requested subtree,
+    looked up once per request for both of the conditional GET headers.
+    """
+    if not hasattr(request, 'menu_validator'):
+        menupath = menu.split("/")[0:-1] if menu else ['1']
+        request.menu_validator = app.api_impl.subtree_validator(menupath[-1])
+    return request.menu_validator
+
+def menu_etag(request, menu):
+    validator = menu_validator(request, menu)
+    if validator is None:
+        return None
+    return '{0}-{1}-{2}'.format(menu.strip('/').split('/')[-1], validator[0], request.GET.get('depth', ''))
+
+def menu_last_modified(request, menu):
+    validator = menu_validator(request, menu)
+    return validator[1] if validator else None
+
+@api_auth()
+@condition(etag_func=menu_etag, last_modified_func=menu_last_modified)
 def menu_get(request, menu):
     """
-    URL=/api/id1/id2.../?depth=#
+    URL=/api/id1/id2.../?depth=#&stream=1
     API returns JSON response containing tree.
     e.g. { 'id': 1, 'name': 'menu_name', 'branches':  }
+    With stream=1 the JSON is streamed as the tree is read.
+    Responses carry ETag and Last-Modified headers, and a request with a
+    matching If-None-Match or If-Modified-Since gets a 304 instead.
     """
     if request.method == 'GET':
         # Retrieve the /?name=<new_name> part of the request.
         depth = request.GET.get('depth')
+        stream = request.GET.get('stream') in ('1', 'true')
         logger.info("api.menu_get('{0}', menu='{1}', depth='{2}')".format(request.get_raw_uri(), menu, depth))
 
         menupath = menu.split("/")[0:-1] if menu else ['1']
 
-        return app.api_impl.menu_get(menupath[-1], depth)
+        return app.api_impl.menu_get(menupath[-1], depth, stream=stream)
+
+@api_auth()
+def menu_children(request, menu):
+    """
+    URL=/api/id1/id2.../children/?after=cursor&limit=#
+    API returns JSON response containing one page of the menu's children
+    and the cursor of the next page, or null after the last page.
+    e.g. { 'children': [{ 'id': 2, 'name': 'menu_name', 'ordinal': 1 }], 'next': '1.2' }
+    """
+    if request.method == 'GET':
+        after = request.GET.get('after')
+        limit = request.GET.get('limit')
+        logger.info("api.menu_children('{0}', menu='{1}', after='{2}')".format(request.get_raw_uri(), menu, after))
+
+        menupath = menu.split("/")[0:-1] if menu else ['1']
+
+        try:
+            after = app.api_impl.decode_cursor(after) if after else None
+            limit = min(int(limit), app.api_impl.MAX_CHILDREN_PAGE_SIZE) if limit else app.api_impl.CHILDREN_PAGE_SIZE
+        except ValueError:
+            return JsonResponse({ 'error': 'Invalid after or limit' }, status=400)
+        if limit < 1:
+            return JsonResponse({ 'error': 'Invalid after or limit' }, status=400)
+        if not Menu.objects.filter(id=int(menupath[-1])).exists():
+            raise Http404("Invalid menu: '{0}'".format(menu))
+        children, next = app.api_impl.current_children_page(menupath[-1], after=after, limit=limit)
+        return JsonResponse({
+            'children': [{ 'id': child.id, 'name': child.name, 'ordinal': child.ordinal } for child in children],
+            'next': next
+            })
+
+@api_auth()
+def menu_export(request, menu):
+    """
+    URL=/api/id1/id2.../export/?format=ndjson|outline&depth=#&root=0
+    API streams the subtree as ndjson (the default) or as an indented outline.
+    With root=0 the menu item itself is left out and only its descendants are exported.
+    """
+    if request.method == 'GET':
+        format = request.GET.get('format', 'ndjson')
+        logger.info("api.menu_export('{0}', menu='{1}', format='{2}')".format(request.get_raw_uri(), menu, format))
+
+        menupath = menu.split("/")[0:-1] if menu else ['1']
+
+        if format not in app.transfer.FORMATS:
+            return JsonResponse({ 'error': 'Unknown format' }, status=400)
+        try:
+            depth = int(request.GET.get('depth', -1))
+        except ValueError:
+            return JsonResponse({ 'error': 'Invalid depth' }, status=400)
+        if not Menu.objects.filter(id=int(menupath[-1])).exists():
+            raise Http404("Invalid menu: '{0}'".format(menu))
+        lines, items, content_type = app.transfer.FORMATS[format]
+        rows = app.transfer.export_rows(menupath[-1], depth)
+        return StreamingHttpResponse(lines(rows, include_root=request.GET.get('root') != '0'), content_type=content_type)
+
+@api_auth('app.add_menu', 'app.add_submenu')
+def menu_import(request, menu):
+    """
+    URL=/api/id1/id2.../import/?format=ndjson|outline
+    The POST body is read line by line and its items added beneath the menu.
+    API returns JSON response containing the number of items added.
+    e.g. { 'count': 12 }
+    """
+    if request.method == 'POST':
+        format = request.GET.get('format', 'ndjson')
+        logger.info("api.menu_import('{0}', menu='{1}', format='{2}')".format(request.get_raw_uri(), menu, format))
+
+        menupath = menu.split("/")[0:-1] if menu else ['1']
+
+        if format not in app.transfer.FORMATS:
+            return JsonResponse({ 'error': 'Unknown format' }, status=400)
+        lines, items, content_type = app.transfer.FORMATS[format]
+        try:
+            count = app.transfer.import_tree(menupath[-1], items(line.decode('utf-8') for line in request))
+            return JsonResponse({ 'count': count })
+        except UnicodeDecodeError:
+            return JsonResponse({ 'error': 'Invalid UTF-8' }, status=400)
+        except app.api_impl.MenuTreeError as e:
+            return JsonResponse({ 'error': str(e) }, status=400)
+        except Menu.DoesNotExist:
+            raise Http404("Invalid menu: '{0}'".format(menu))
+    else:
+        return redirect('/menu/{0}/'.format(menu))
+
+@api_auth()
+def menu_search(request):
+    """
+    URL=/api/search/?q=words&page=#&limit=#
+    API returns JSON response containing a page of the menu items whose name
+    or data contain all the words, best matches first, each with its
+    ancestors, and the number of the next page, or null after the last page.
+    e.g. { 'results': [{ 'id': 42, 'name': 'Soup', 'path': '/1/5/42/', 'rank': -2.1,
+           'ancestors': [{ 'id': 1, 'name': 'RU App' }, { 'id': 5, 'name': 'Starters' }] }], 'next': 2 }
+    """
+    if request.method == 'GET':
+        text = request.GET.get('q', '')
+        logger.info("api.menu_search('{0}', q='{1}')".format(request.get_raw_uri(), text))
+        try:
+            page = int(request.GET.get('page', 1))
+            limit = min(int(request.GET.get('limit', app.search.SEARCH_PAGE_SIZE)), app.search.MAX_SEARCH_PAGE_SIZE)
+        except ValueError:
+            return JsonResponse({ 'error': 'Invalid page or limit' }, status=400)
+        if page < 1 or limit < 1:
+            return JsonResponse({ 'error': 'Invalid page or limit' }, status=400)
+        hits, next = app.search.search(text, page=page, limit=limit)
+        return JsonResponse({
+            'results': [{
+                'id': hit.id,
+                'name': hit.name,
+                'path': hit.path,
+                'rank': hit.rank,
+                'ancestors': [{ 'id': ancestor.id, 'name': ancestor.name } for ancestor in hit.ancestors]
+                } for hit in hits],
+            'next': next
+            })
+
+@api_auth()
+def menu_changes(request):
+    """
+    URL=/api/changes/?since=#&limit=#
+    API returns JSON response containing the changes made to the tree after
+    the sequence number since, oldest first, the sequence number to ask
+    for the next changes after, and whether more changes are waiting.
+    Without since no changes are returned, only the latest sequence number.
+    Responds 410 if the changes have been trimmed from the journal, and the
+    tree must be downloaded again.
+    e.g. { 'changes': [{ 'seq': 8, 'action': 'edit', 'id': 42, 'name': 'Soup' }], 'latest': 8, 'more': false }
+    """
+    if request.method == 'GET':
+        since = request.GET.get('since')
+        logger.info("api.menu_changes('{0}', since='{1}')".format(request.get_raw_uri(), since))
+        if since is None:
+            return JsonResponse({ 'changes': [], 'latest': app.journal.latest(), 'more': False })
+        try:
+            since = int(since)
+            limit = min(int(request.GET.get('limit', app.journal.CHANGES_PAGE_SIZE)), app.journal.MAX_CHANGES_PAGE_SIZE)
+        except ValueError:
+            return JsonResponse({ 'error': 'Invalid since or limit' }, status=400)
+        if since < 0 or limit < 1:
+            return JsonResponse({ 'error': 'Invalid since or limit' }, status=400)
+        try:
+            changes, more = app.journal.changes(since, limit=limit)
+        except app.journal.JournalCompacted as e:
+            return JsonResponse({ 'error': str(e), 'latest': app.journal.latest() }, status=410)
+        return JsonResponse({
+            'changes': changes,
+            'latest': changes[-1]['seq'] if changes else since,
+            'more': more
+            })
+
+@api_auth()
+def menu_batch(request):
+    """
+    URL=/api/batch/
+    The POST body is a JSON list of operations, applied in order in one
+    transaction; see app.batch. Either all of them take effect or none do.
+    API returns JSON response containing the ids of the new items by their
+    temporary ids, or the error and the index of the failed operation.
+    e.g. { 'ids': { 'soup': 42 } }
+    """
+    if request.method == 'POST':
+        logger.info("api.menu_batch('{0}')".format(request.get_raw_uri()))
+        try:
+            operations = json.loads(request.body.decode('utf-8'))
+        except ValueError:
+            return JsonResponse({ 'error': 'Invalid JSON' }, status=400)
+        if isinstance(operations, list) and not request.user.has_perms(app.batch.permissions(operations)):
+            return JsonResponse({ 'error': 'Permission denied' }, status=403)
+        try:
+            return JsonResponse({ 'ids': app.batch.run(operations) })
+        except app.batch.BatchError as e:
+            return JsonResponse({ 'error': str(e), 'index': e.index }, status=400)
+        except app.api_impl.MenuTreeError as e:
+            return JsonResponse({ 'error': str(e) }, status=400)
+    else:
+        return redirect('/menu/1/')
@@ -2,20 +2,57 @@
 API implementation.
 """
 
-from django.http import JsonResponse
-from django.db import transaction
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse, Http404
+from django.db import transaction, connection
+from django.db.models import F, Q, Max, Value, Case, When, PositiveIntegerField
+from django.db.models.functions import Concat, Substr
+from django.utils import six, timezone
 
+from contextlib import contextmanager
+import itertools
+import json
 import logging
+import threading
+import uuid
 from app.models import Menu, Submenu
+from app.compact import CompactTree
+import app.journal as journal
+import app.jsoncache as jsoncache
+import app.replica as replica
+import app.snapshot as snapshot
+import app.traversal as traversal
 
 logger = logging.getLogger(__name__)
 
+# Number of menu levels including the root, as presented by menu.html.
+MAX_MENU_DEPTH = 7
+
+# Number of ids per DELETE ... WHERE id IN (...) statement.
+# SQLite allows at most 999 parameters per statement.
+DELETE_CHUNK_SIZE = 500
+
+# Largest value Submenu.ordinal can hold.
+MAX_ORDINAL = 2147483647
+
+# Default and largest number of children per page of a menu.
+CHILDREN_PAGE_SIZE = 100
+MAX_CHILDREN_PAGE_SIZE = 1000
+
+class MenuTreeError(Exception):
+    """
+    Raised when an operation would leave the menu tree in an invalid shape.
+    """
+    pass
+
 class MenuItem(object):
     """
     Temporary data for gathering child menu items.
     This is effectively the output from a traversal of the tree
     which is intended to be stored in an (ordered) list.
     """
+    __slots__ = ('id', 'name', 'data')
+
     def __init__(self, id, name, data):
         self.id = id
         self.name = name
@@ -31,34 +68,90 @@ class ChildMenu(MenuItem):
     This is effectively the output from a traversal of the tree
     which is intended to be stored in an (ordered) list.
     """
-    def __init__(self, id, name, data, parentid, ordinal=0):
+    __slots__ = ('parentid', 'ordinal', 'child_count', 'descendant_count')
+
+    def __init__(self, id, name, data, parentid, ordinal=0, child_count=0, descendant_count=0):
         self.parentid = parentid
         self.ordinal = ordinal
+        self.child_count = child_count
+        self.descendant_count = descendant_count
         super(ChildMenu, self).__init__(id=id, name=name, data=data)
 
     def __str__(self):
         return "{{'id': {0}, 'name': '{1}', 'data': '{2}', 'parentid': {3}, 'ordinal': {4}}}".format(
             self.id, self.name, self.data, self.parentid, self.ordinal)
 
+def menu_path(menuid):
+    """
+    Returns the (path, depth) pair of menuid, e.g. ('/1/5/42/', 2).
+    Menu items without a Submenu record are roots: ('/1/', 0).
+    """
+    try:
+        return Submenu.objects.values_list('path', 'depth').get(child=int(menuid))
+    except Submenu.DoesNotExist:
+        return '/{0}/'.format(menuid), 0
+
+def path_ids(path):
+    """
+    Parse a materialized path into the list of ids from the root down.
+    """
+    return [int(id) for id in path.strip('/').split('/')]
+
+def parent_path(path):
+    """
+    The materialized path of the parent of the item at path.
+    """
+    return path[:path.rstrip('/').rfind('/') + 1]
+
+# Whether app_submenu has the lpath column, by database name.
+_has_ltree = {}
+
+def has_ltree():
+    """
+    Whether app_submenu has the GiST indexed ltree copy of path, lpath,
+    added by migration 0012 on PostgreSQL. Looked up once per database in
+    each process, so a database that has not been migrated, or whose server
+    lacks the ltree extension, keeps using the path range scans.
+    """
+    if connection.vendor != 'postgresql':
+        return False
+    name = connection.settings_dict['NAME']
+    if name not in _has_ltree:
+        with connection.cursor() as cursor:
+            columns = connection.introspection.get_table_description(cursor, Submenu._meta.db_table)
+        _has_ltree[name] = any(column.name == 'lpath' for column in columns)
+    return _has_ltree[name]
+
+def path_ltree(path):
+    """
+    The ltree form of a materialized path, e.g. '1.5.42' for '/1/5/42/'.
+    """
+    return path.strip('/').replace('/', '.')
+
+def submenus_within(path):
+    """
+    Returns the Submenu records of all the descendants of the item at path.
+    Every descendant path starts with path, so this is a range scan on the
+    path index: '/' sorts immediately before '0'. That holds for SQLite's
+    binary collation but not for every PostgreSQL collation, so there the
+    lpath <@ operator is used with its GiST index instead.
+    """
+    if has_ltree():
+        lpath = path_ltree(path)
+        return Submenu.objects.extra(where=['lpath <@ %s::ltree', 'lpath <> %s::ltree'], params=[lpath, lpath])
+    return Submenu.objects.filter(path__gt=path, path__lt=path[:-1] + '0')
+
 def gather_ancestors(menuid):
     """
     Build a list of MenuItem objects representing the path to menuid.
     Raises exception Submenu.DoesNotExist if menuid is not found.
     """
-    ancestors = [MenuItem(id=1,name='',data='')] # Root menu is the ancestor of all.
-    while True:
-        if menuid == 1:
-            # root node is already there so stop iterating.
-            break
-        submenu = Submenu.objects.get(child=int(menuid))
-        # Here we don't care about the name so we don't look it up.
-        # For extra certainty the lookup ought to be done anyway.
-        # That may change later but for now, I'm leaving it blank.
-        menuitem = MenuItem(id=menuid, name='', data='')
-        ancestors.append(menuitem)
-        menuid = submenu.parent.id
-
-    return ancestors
+    if int(menuid) == 1:
+        # Root menu is the ancestor of all.
+        return [MenuItem(id=1, name='', data='')]
+    path = Submenu.objects.values_list('path', flat=True).get(child=int(menuid))
+    # Here we don't care about the name so we don't look it up.
+    return [MenuItem(id=id, name='', data='') for id in path_ids(path)]
 
 def gather_children(parentid):
     """
@@ -71,18 +164,209 @@ def gather_children(parentid):
     # parentid must correspond to an existing menu item.
     parentmenu = Menu.objects.get(id=parentid)
 
-    children = []
-    submenus = Submenu.objects.filter(parent=parentid).order_by('ordinal', 'child_id')
-    for submenu in submenus:
-        menu = Menu.objects.get(id=submenu.child.id)
-        childmenu = ChildMenu(id=int(menu.id), name=menu.name, data=menu.data, parentid=parentmenu.id, ordinal=submenu.ordinal)
-        children.append(childmenu)
+    rows = Submenu.objects.filter(parent=parentid).order_by('ordinal', 'child_id').values_list(
+        'child_id', 'child__name', 'child__data', 'ordinal', 'child__child_count', 'child__descendant_count')
+    return [ChildMenu(id=id, name=name, data=data, parentid=parentmenu.id, ordinal=ordinal,
+                      child_count=child_count, descendant_count=descendant_count)
+            for id, name, data, ordinal, child_count, descendant_count in rows]
+
+def encode_cursor(child):
+    """
+    The keyset cursor that continues a page of children after child.
+    """
+    return '{0}.{1}'.format(child.ordinal, child.id)
+
+def decode_cursor(cursor):
+    """
+    Returns the (ordinal, child_id) pair of a cursor from encode_cursor.
+    Raises ValueError if it is malformed.
+    """
+    ordinal, childid = cursor.split('.')
+    return int(ordinal), int(childid)
+
+def gather_children_page(parentid, after=None, limit=CHILDREN_PAGE_SIZE):
+    """
+    Returns a page of at most limit ChildMenu objects of Menu 'parentid',
+    continuing after the (ordinal, child_id) pair from decode_cursor,
+    together with the cursor of the following page or None at the end.
+    Uses the (parent, ordinal, child) index so the cost of a page does not
+    depend on how many children come before it.
+    """
+    submenus = Submenu.objects.filter(parent=parentid)
+    if after is not None:
+        ordinal, childid = after
+        # ordinal >= x lets the index seek straight to the page.
+        submenus = submenus.filter(ordinal__gte=ordinal).filter(
+            Q(ordinal__gt=ordinal) | Q(child_id__gt=childid))
+    rows = submenus.order_by('ordinal', 'child_id').values_list(
+        'child_id', 'child__name', 'child__data', 'ordinal', 'child__child_count', 'child__descendant_count')[:limit + 1]
+    children = [ChildMenu(id=id, name=name, data=data, parentid=int(parentid), ordinal=ordinal,
+                          child_count=child_count, descendant_count=descendant_count)
+                for id, name, data, ordinal, child_count, descendant_count in rows]
+    if len(children) > limit:
+        children = children[:limit]
+        return children, encode_cursor(children[-1])
+    return children, None
+
+def current_children_page(parentid, after=None, limit=CHILDREN_PAGE_SIZE):
+    """
+    As gather_children_page, but served from the in-process replica when that
+    is enabled. Intended for read only views.
+    """
+    if not replica.enabled():
+        return gather_children_page(parentid, after=after, limit=limit)
+    nodes, more = replica.current().children_page(int(parentid), after=after, limit=limit)
+    children = [ChildMenu(id=node.id, name=node.name, data=node.data, parentid=node.parentid, ordinal=node.ordinal,
+                          child_count=node.child_count, descendant_count=node.descendant_count)
+                for node in nodes]
+    return children, encode_cursor(children[-1]) if more else None
+
+def current_children(parentid):
+    """
+    As gather_children, but served from the in-process replica when that
+    is enabled. Intended for read only views; writers use gather_children.
+    """
+    if not replica.enabled():
+        return gather_children(parentid=parentid)
+    return [ChildMenu(id=node.id, name=node.name, data=node.data, parentid=node.parentid, ordinal=node.ordinal,
+                      child_count=node.child_count, descendant_count=node.descendant_count)
+            for node in replica.current().children_of(int(parentid))]
+
+# The ids collected by deferred_tree_changes in this thread, if it is active.
+_deferred = threading.local()
+
+@contextmanager
+def deferred_tree_changes():
+    """
+    Within the block, tree_changed only collects the ids it is called with,
+    and they are all handled by one call when the block ends without an
+    exception, e.g. after a batch of writes. Use it inside the transaction
+    of the writes, as tree_changed.
+    """
+    if getattr(_deferred, 'menuids', None) is not None:
+        # Already deferred by an enclosing block.
+        yield
+        return
+    _deferred.menuids = set()
+    try:
+        yield
+        menuids = _deferred.menuids
+    finally:
+        _deferred.menuids = None
+    if menuids:
+        tree_changed(*menuids)
+
+def tree_changed(*menuids):
+    """
+    Notify readers that Menu or Submenu records have been modified.
+    Every code path that writes to the tree must call this afterwards, in
+    the same transaction, with the ids of the changed items (or the parent
+    of a deleted item). These items and all their ancestors get a new
+    version and modified time, so the new versions commit with the write;
+    they lose their cached JSON once it has committed.
+    """
+    if getattr(_deferred, 'menuids', None) is not None:
+        _deferred.menuids.update(menuids)
+        return
+    if menuids:
+        paths = dict(Submenu.objects.filter(child_id__in=menuids).values_list('child_id', 'path'))
+        ids = set()
+        for menuid in menuids:
+            ids.update(path_ids(paths.get(menuid) or '/{0}/'.format(menuid)))
+        Menu.objects.filter(id__in=ids).update(version=F('version') + 1, modified=timezone.now())
+        transaction.on_commit(lambda: jsoncache.invalidate(ids))
+    replica.invalidate()
+
+def subtree_validator(menuid):
+    """
+    Returns the (version, modified) pair of menuid, which changes whenever
+    anything in its subtree does, or None if menuid does not exist.
+    Read from the in-process replica when that is enabled.
+    """
+    if replica.enabled():
+        node = replica.current().nodes.get(int(menuid))
+        return (node.version, node.modified) if node is not None else None
+    try:
+        return Menu.objects.values_list('version', 'modified').get(id=int(menuid))
+    except Menu.DoesNotExist:
+        return None
+
+def add_counts(path, children, descendants):
+    """
+    Adjust the denormalized counts when items are added beneath (or removed
+    from) the item at path: its child_count changes by children, and the
+    descendant_count of it and of all its ancestors by descendants.
+    One UPDATE; must be called in the same transaction as the change.
+    """
+    ids = path_ids(path)
+    Menu.objects.filter(id__in=ids).update(
+        descendant_count=F('descendant_count') + descendants,
+        child_count=Case(When(id=ids[-1], then=F('child_count') + children), default=F('child_count')))
+
+def apply_counts(children, descendants):
+    """
+    Adjust the denormalized counts of many items at once: children and
+    descendants map menu ids to the changes in their child_count and
+    descendant_count. One UPDATE; must be called in the same transaction
+    as the change.
+    """
+    ids = set(children) | set(descendants)
+    if not ids:
+        return
+    Menu.objects.filter(id__in=ids).update(
+        child_count=Case(*[When(id=id, then=F('child_count') + count) for id, count in children.items()],
+                         default=F('child_count')),
+        descendant_count=Case(*[When(id=id, then=F('descendant_count') + count) for id, count in descendants.items()],
+                              default=F('descendant_count')))
+
+# Count the children and the descendants of menu items in one statement.
+# The descendants of an item are the range of paths that start with its path.
+RECOUNT_SQL = """
+UPDATE app_menu SET
+    child_count = (SELECT COUNT(*) FROM app_submenu s WHERE s.parent_id = app_menu.id),
+    descendant_count = (
+        SELECT COUNT(*) FROM app_submenu s, (
+            SELECT COALESCE(
+                (SELECT o.path FROM app_submenu o WHERE o.child_id = app_menu.id),
+                '/' || app_menu.id || '/') AS path
+        ) own
+        WHERE s.path > own.path AND s.path < substr(own.path, 1, length(own.path) - 1) || '0')
+"""
+
+# RECOUNT_SQL for PostgreSQL, where the descendants are found with lpath <@.
+RECOUNT_LTREE_SQL = """
+UPDATE app_menu SET
+    child_count = (SELECT COUNT(*) FROM app_submenu s WHERE s.parent_id = app_menu.id),
+    descendant_count = (
+        SELECT COUNT(*) FROM app_submenu s
+        WHERE s.lpath <@ COALESCE(
+                (SELECT o.lpath FROM app_submenu o WHERE o.child_id = app_menu.id),
+                text2ltree(app_menu.id::text))
+            AND s.child_id <> app_menu.id)
+"""
 
-    return children
+def recount(menuid=None):
+    """
+    Recompute the child_count and descendant_count of every menu item,
+    or of menuid and its descendants, from the Submenu records.
+    Returns the number of menu items updated.
+    """
+    sql, params = RECOUNT_LTREE_SQL if has_ltree() else RECOUNT_SQL, []
+    if menuid is not None:
+        path = menu_path(menuid)[0]
+        if has_ltree():
+            sql += "WHERE app_menu.id = %s OR app_menu.id IN (SELECT child_id FROM app_submenu WHERE lpath <@ %s::ltree)"
+            params = [int(menuid), path_ltree(path)]
+        else:
+            sql += "WHERE app_menu.id = %s OR app_menu.id IN (SELECT child_id FROM app_submenu WHERE path > %s AND path < %s)"
+            params = [int(menuid), path, path[:-1] + '0']
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
 
 def gather_descendants(descendants, parentid, postorder=True, depth = -1):
     """
-    Recursive post-order traversal of the tree.
+    Traversal of the tree beneath parentid.
     Stores the ChildMenu objects collected at each node
     in pre or post order.
 
@@ -92,31 +376,26 @@ def gather_descendants(descendants, parentid, postorder=True, depth = -1):
     postorder: ==True is used for performing the delete branch operation.
     postorder: ==False Pre order is used for presentation (reporting) purposes.
 
-    depth: ==-1 implies all children; == 0 is terminates the recursion.
+    depth: ==-1 implies all children; == 0 gathers nothing.
 
+    Raises Menu.DoesNotExist if parentid is not found.
     """
-    # Don't include the parentid in the returned collection.
-    if depth == 0:
-        return
-    elif depth > 0:
-        depth = depth - 1
-
-    # Gather the next descendants.
-    children = gather_children(parentid=parentid)
-    for child in children:
-        # The order of operations here makes descendants a pre or post order list.
-        if not postorder:
-            descendants.append(child)
-        gather_descendants(descendants=descendants, parentid=child.id, postorder=postorder, depth=depth)
-        # The sequence will then be suitable for deleting children first.
-        if postorder:
-            descendants.append(child)
+    tree = load_tree(parentid, depth)
+    if tree is None:
+        raise Menu.DoesNotExist("Menu {0} does not exist".format(parentid))
+
+    order = traversal.POSTORDER if postorder else traversal.PREORDER
+    for node, parent, level in traversal.walk(tree, branches, order=order):
+        # Don't include the parentid in the returned collection.
+        if parent is not None:
+            descendants.append(ChildMenu(id=node.id, name=node.name, data=node.data,
+                                         parentid=parent.id, ordinal=node.ordinal))
     # return the passed parameter for convenience.
     return descendants
 
 def gather_all_descendants(chosenid, postorder):
     """
-    Kick off the recursive descent of the menu tree.
+    Kick off the descent of the menu tree.
     See gather_descendants for details of the postorder flag.
     """
     return gather_descendants(descendants=[], parentid=chosenid, postorder=postorder)
@@ -125,40 +404,192 @@ class Tree(MenuItem):
     """
     Temporary data for gathering the tree of menu items.
     """
-    def __init__(self, id, name, data):
+    __slots__ = ('ordinal', 'branches')
+
+    def __init__(self, id, name, data, ordinal=0):
         super(Tree, self).__init__(id=id, name=name, data=data)
+        self.ordinal = ordinal
         self.branches = [] # A list of Tree nodes.
 
     def __str__(self):
         return str(super(Tree, self))
 
+def branches(tree):
+    """
+    The children of a Tree node, for traversal.walk.
+    """
+    return tree.branches
+
+# Selects the subtree rooted at %(root)s in a single round trip.
+# Each row is (id, parent_id, ordinal, level, name, data).
+# Rows are ordered by level so that every parent precedes its children,
+# and by ordinal within a level so siblings arrive in display order.
+SUBTREE_SQL = """
+WITH RECURSIVE subtree(id, parent_id, ordinal, level) AS (
+    SELECT m.id, s.parent_id, COALESCE(s.ordinal, 0), 0
+    FROM app_menu m LEFT JOIN app_submenu s ON s.child_id = m.id
+    WHERE m.id = %s
+    UNION ALL
+    SELECT s.child_id, s.parent_id, s.ordinal, subtree.level + 1
+    FROM app_submenu s JOIN subtree ON s.parent_id = subtree.id
+    WHERE %s < 0 OR subtree.level < %s
+)
+SELECT subtree.id, subtree.parent_id, subtree.ordinal, subtree.level, m.name, m.data
+FROM subtree JOIN app_menu m ON m.id = subtree.id
+ORDER BY subtree.level, subtree.ordinal, subtree.id
+"""
+
+def load_tree(id, depth=-1):
+    """
+    Creates a Tree from the Menu/Submenu data using one recursive query,
+    or from the in-process replica when that is enabled.
+    Returns None if the menu item id does not exist.
+
+    id: The menu item at which to begin the traversal.
+    depth: -1 == all, 0 == root only, N>0 == N levels of child nodes
+    """
+    depth = int(depth)
+    if replica.enabled():
+        rows = replica.current().subtree_rows(int(id), depth)
+    else:
+        with connection.cursor() as cursor:
+            cursor.execute(SUBTREE_SQL, [int(id), depth, depth])
+            rows = cursor.fetchall()
+
+    if not rows:
+        return None
+
+    nodes = {}
+    for nodeid, parentid, ordinal, level, name, data in rows:
+        node = Tree(id=nodeid, name=name, data=data, ordinal=ordinal)
+        nodes[nodeid] = node
+        if level > 0:
+            # The level ordering guarantees the parent was seen already.
+            nodes[parentid].branches.append(node)
+    return nodes[rows[0][0]]
+
+# Selects the subtree rooted at %(root)s in pre-order (depth first).
+# Each row holds the {columns} of subtree and of its Menu m.
+# The sort key appends the zero padded (ordinal, id) of each level,
+# so ordering by it visits every parent before its children and siblings
+# in display order. {sortkey} and {columns} are filled in by preorder_sql.
+PREORDER_SQL = """
+WITH RECURSIVE subtree(id, parent_id, ordinal, level, sortkey) AS (
+    SELECT m.id, s.parent_id, COALESCE(s.ordinal, 0), 0, CAST('' AS TEXT)
+    FROM app_menu m LEFT JOIN app_submenu s ON s.child_id = m.id
+    WHERE m.id = %s
+    UNION ALL
+    SELECT s.child_id, s.parent_id, s.ordinal, subtree.level + 1,
+        subtree.sortkey || {sortkey}
+    FROM app_submenu s JOIN subtree ON s.parent_id = subtree.id
+    WHERE %s < 0 OR subtree.level < %s
+)
+SELECT {columns}
+FROM subtree JOIN app_menu m ON m.id = subtree.id
+ORDER BY subtree.sortkey
+"""
+
+# The columns of the (id, ordinal, level, name) rows of iter_subtree.
+PREORDER_COLUMNS = 'subtree.id, subtree.ordinal, subtree.level, m.name'
+
+# The zero padded (ordinal, id) of the Submenu s, in each backend's SQL.
+SORTKEY_SQL = {
+    'sqlite': "printf('%%010d%%010d', s.ordinal, s.child_id)",
+    'postgresql': "lpad(s.ordinal::text, 10, '0') || lpad(s.child_id::text, 10, '0')",
+    }
+
+def preorder_sql(columns=PREORDER_COLUMNS):
+    """
+    PREORDER_SQL selecting columns, for the database in use.
+    """
+    return PREORDER_SQL.format(sortkey=SORTKEY_SQL.get(connection.vendor, SORTKEY_SQL['sqlite']), columns=columns)
+
+def iter_query(sql, params, size=1000):
+    """
+    Yields the rows of a query, fetching size rows at a time.
+    On PostgreSQL a named (server side) cursor is used, so that the client
+    does not receive the whole result at once; it must live in a transaction.
+    """
+    if connection.vendor == 'postgresql':
+        with transaction.atomic():
+            connection.ensure_connection()
+            cursor = connection.connection.cursor(name='wordtree_{0}'.format(uuid.uuid4().hex))
+            cursor.itersize = size
+            try:
+                cursor.execute(sql, params)
+                for row in cursor:
+                    yield row
+            finally:
+                cursor.close()
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+def iter_subtree(id, depth=-1, size=1000, columns=PREORDER_COLUMNS):
+    """
+    Yields the (id, ordinal, level, name) rows, or those of other columns,
+    of the subtree rooted at id in pre-order, fetching size rows at a time
+    from the database.
+    """
+    depth = int(depth)
+    return iter_query(preorder_sql(columns), [int(id), depth, depth], size)
+
+def load_compact_tree(id, depth=-1):
+    """
+    Creates a CompactTree of the subtree rooted at id, streaming the rows
+    from iter_subtree or from the in-process replica when that is enabled.
+    An up to date snapshot file, when one is configured, is used first.
+    Returns None if the menu item id does not exist.
+    """
+    mapped = snapshot.current()
+    if mapped is not None:
+        tree = mapped.subtree(int(id), int(depth))
+        if tree is not None:
+            return tree
+    if replica.enabled():
+        rows = replica.current().subtree_preorder(int(id), int(depth))
+    else:
+        rows = iter_subtree(id, depth)
+    return CompactTree.from_rows(rows)
+
+def iter_tree_json(rows):
+    """
+    Yields the JSON text of dictFromTree, one piece per node,
+    given the pre-order rows of iter_subtree.
+    Only the level of the previous node is kept, so memory use does not
+    depend on the size of the tree.
+    """
+    previous = -1
+    for id, ordinal, level, name in rows:
+        if previous >= level:
+            # Close the previous node and any finished ancestors.
+            yield ']}' * (previous - level + 1) + ', '
+        yield '{{"id": {0}, "name": {1}, "ordinal": {2}, "submenu": ['.format(id, json.dumps(name), ordinal)
+        previous = level
+    yield ']}' * (previous + 1)
 
 def build_tree(report, id, depth=0):
     """
     Creates a Tree from the Menu/Submenu data.
-    Counts the nodes as it traverses them.
+    Counts the nodes it loads.
 
     id: The menu item at which to begin the traversal.
     depth: -1 == all, 0 == root only, N>0 == N levels of child nodes
     """
-    try:
-        menu = Menu.objects.get(id=id)
-    except Menu.DoesNotExist:
+    tree = load_tree(id, depth)
+    if tree is None:
         return []
 
-    # Gather the next descendants.
-    tree = Tree(id=menu.id, name=menu.name, data=menu.data)
-
     # Increment the count of nodes.
-    report['count'] = report['count'] + 1
-
-    if depth != 0:
-        # Traverse the children
-        submenus = gather_children(parentid=id)
-        for submenu in submenus:
-            branch = build_tree(report, id=int(submenu.id), depth=(depth-1))
-            # Add each branch to the tree.
-            tree.branches.append(branch)
+    for node, parent, level in traversal.walk(tree, branches):
+        report['count'] = report['count'] + 1
 
     return tree
 
@@ -166,86 +597,451 @@ def build_report():
     """
     Construct a dictionary to hold the report results.
     This includes the Tree itself and a count of the nodes.
+    The tree is a CompactTree, presented through its root node's view.
     """
     # Don't count the root node. Set count to -1 initially.
-    report = { 'tree': None, 'count': -1 }
-    # build_tree_from only updates the count member.
-    report['tree'] = build_tree(report, id=1)
+    report = { 'tree': None, 'count': -1, 'total': 0 }
+    tree = load_compact_tree(1, depth=-1)
+    if tree is not None:
+        report['tree'] = tree.node(0)
+        report['count'] = len(tree) - 1
+        report['total'] = Menu.objects.values_list('descendant_count', flat=True).get(id=1)
     return report
 
 def menu_add(parentid, new_name):
     """
     Add new_name item to the menu parentid.
     Return JSON response with new id and name.
+    Raises MenuTreeError if the parent is already at the maximum depth.
     """
     logger.info("api_impl.menu_add(parentid={0}, new_name='{1}')".format(parentid, new_name))
     id = int(parentid)
     parentmenu = Menu.objects.get(id=id)
-    ordinal = len(gather_children(parentid=id)) + 1
+    parentpath, parentdepth = menu_path(id)
+    if parentdepth + 1 >= MAX_MENU_DEPTH:
+        raise MenuTreeError('Menus cannot be nested more than {0} levels deep.'.format(MAX_MENU_DEPTH))
 
     with transaction.atomic():
+        ordinal = next_ordinal(id)
         newmenu = Menu.objects.create(name=new_name, data='')
-        submenu = Submenu.objects.create(parent=parentmenu, child=newmenu, ordinal=ordinal)
+        submenu = Submenu.objects.create(parent=parentmenu, child=newmenu, ordinal=ordinal,
+            path='{0}{1}/'.format(parentpath, newmenu.id), depth=parentdepth + 1)
+        add_counts(parentpath, 1, 1)
+        journal.record('add', id=newmenu.id, parent=id, ordinal=ordinal, name=new_name)
+        tree_changed(newmenu.id)
     #
     # Output is a JSON string built from this dict.
     #
     return JsonResponse({ 'id': newmenu.id, 'name': new_name })
 
-def initialise_ordinals(children, startat=0):
+def bulk_create_menus(menus):
+    """
+    Insert the Menu objects with bulk_create and return their new ids in order.
+    Must be called inside transaction.atomic().
+
+    Backends that cannot return ids from a bulk insert hand out increasing ids,
+    and nothing else can insert until the transaction ends (SQLite holds its
+    write lock, PostgreSQL takes a table lock), so the new ids are the
+    len(menus) largest in the table.
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('LOCK TABLE app_menu IN EXCLUSIVE MODE')
+    Menu.objects.bulk_create(menus)
+    if menus and menus[0].pk is None:
+        ids = list(Menu.objects.order_by('-id').values_list('id', flat=True)[:len(menus)])
+        ids.reverse()
+        for menu, id in zip(menus, ids):
+            menu.id = id
+    return [menu.id for menu in menus]
+
+def check_menu_name(name):
+    """
+    Raises MenuTreeError unless name is a non-empty string that fits Menu.name.
+    """
+    if not isinstance(name, six.string_types) or not name or len(name) > Menu._meta.get_field('name').max_length:
+        raise MenuTreeError('Invalid menu name: {0!r}'.format(name))
+
+def flatten_items(items):
+    """
+    Flatten a JSON list of new menu items into pre-order (name, parent_index, level)
+    tuples. Each item is either a name or { 'name': name, 'submenu': [items] }.
+    parent_index refers to an earlier entry, or is None for the top level.
+    Raises MenuTreeError if an item is malformed.
+    """
+    if not isinstance(items, list):
+        raise MenuTreeError('Expected a list of menu items.')
+    flat = []
+    pending = [(item, None, 1) for item in reversed(items)]
+    while pending:
+        item, parentindex, level = pending.pop()
+        if isinstance(item, dict):
+            name = item.get('name')
+            submenu = item.get('submenu', [])
+        else:
+            name = item
+            submenu = []
+        check_menu_name(name)
+        if not isinstance(submenu, list):
+            raise MenuTreeError('Expected a list of menu items beneath {0!r}.'.format(name))
+        flat.append((name, parentindex, level))
+        index = len(flat) - 1
+        pending.extend((child, index, level + 1) for child in reversed(submenu))
+    return flat
+
+def menu_bulk_add(parentid, items):
+    """
+    Add a list or nested tree of new items beneath the menu parentid
+    with two bulk inserts in one transaction. See flatten_items.
+    Returns the new ids in the order the items were submitted (pre-order).
+    Raises MenuTreeError if the items are malformed or nested too deeply.
+    """
+    flat = flatten_items(items)
+    logger.info("api_impl.menu_bulk_add(parentid={0}) adding {1} items".format(parentid, len(flat)))
+    id = int(parentid)
+    parentmenu = Menu.objects.get(id=id)
+    parentpath, parentdepth = menu_path(id)
+    if flat and parentdepth + max(level for name, parentindex, level in flat) >= MAX_MENU_DEPTH:
+        raise MenuTreeError('Menus cannot be nested more than {0} levels deep.'.format(MAX_MENU_DEPTH))
+
+    # The counts of the new items, each added to its parent's in reverse pre-order.
+    children = [0] * len(flat)
+    descendants = [0] * len(flat)
+    for index in reversed(range(len(flat))):
+        parentindex = flat[index][1]
+        if parentindex is not None:
+            children[parentindex] += 1
+            descendants[parentindex] += descendants[index] + 1
+
+    gap = ordinal_gap()
+    with transaction.atomic():
+        ordinals = { None: next_ordinal(id) - gap }
+        ids = bulk_create_menus([Menu(name=name, data='', child_count=childcount, descendant_count=descendantcount)
+                                 for (name, parentindex, level), childcount, descendantcount
+                                 in zip(flat, children, descendants)])
+        paths = []
+        submenus = []
+        for (name, parentindex, level), childid in zip(flat, ids):
+            ordinal = ordinals.get(parentindex, 0) + gap
+            ordinals[parentindex] = ordinal
+            if parentindex is None:
+                parent, path = id, parentpath
+            else:
+                parent, path = ids[parentindex], paths[parentindex]
+            path = '{0}{1}/'.format(path, childid)
+            paths.append(path)
+            submenus.append(Submenu(parent_id=parent, child_id=childid, ordinal=ordinal,
+                                    path=path, depth=parentdepth + level))
+        Submenu.objects.bulk_create(submenus)
+        if flat:
+            add_counts(parentpath, sum(1 for name, parentindex, level in flat if parentindex is None), len(flat))
+        journal.record_many('add', [{'id': submenu.child_id, 'parent': submenu.parent_id, 'ordinal': submenu.ordinal, 'name': name}
+                                    for submenu, (name, parentindex, level) in zip(submenus, flat)])
+        tree_changed(id)
+    return ids
+
+def move_subtree(submenu, parentid, parentpath, parentdepth):
+    """
+    Re-attach submenu (and so all its descendants) beneath the menu parentid,
+    whose path and depth are given, keeping the materialized path and depth
+    of the whole subtree correct.
+    The caller is responsible for the ordinal and for saving submenu.
+    Returns the number of descendants moved with submenu.
+    Raises MenuTreeError if the subtree would exceed the maximum depth.
+    """
+    oldpath = submenu.path
+    newpath = '{0}{1}/'.format(parentpath, submenu.child_id)
+    delta = parentdepth + 1 - submenu.depth
+    descendants = submenus_within(oldpath)
+    if delta > 0:
+        deepest = descendants.aggregate(deepest=Max('depth'))['deepest'] or submenu.depth
+        if deepest + delta >= MAX_MENU_DEPTH:
+            raise MenuTreeError('Menus cannot be nested more than {0} levels deep.'.format(MAX_MENU_DEPTH))
+
+    moved = 0
+    if newpath != oldpath:
+        moved = descendants.update(
+            path=Concat(Value(newpath), Substr('path', len(oldpath) + 1)),
+            depth=F('depth') + delta)
+    submenu.parent_id = parentid
+    submenu.path = newpath
+    submenu.depth = parentdepth + 1
+    return moved
+
+def change_parent(childid, parentid):
+    """
+    Move the menu childid, with all its descendants, to the end of the
+    children of the menu parentid. Returns the new path of childid.
+    The new parent's path lists all of its ancestors, so the one lookup
+    both places the subtree and detects an attempt to move a menu beneath
+    itself. The subtree's paths are rewritten by a single UPDATE.
+    Raises MenuTreeError if parentid is childid or one of its descendants,
+    or if the subtree would exceed the maximum depth.
+    Raises Submenu.DoesNotExist if childid is the root or does not exist,
+    and Menu.DoesNotExist if parentid does not exist.
+    """
+    childid, parentid = int(childid), int(parentid)
+    logger.info("api_impl.change_parent(childid={0}, parentid={1})".format(childid, parentid))
+    with transaction.atomic():
+        submenu = Submenu.objects.get(child=childid)
+        parentpath, parentdepth = menu_path(parentid)
+        if parentdepth == 0 and not Menu.objects.filter(id=parentid).exists():
+            raise Menu.DoesNotExist("Menu {0} does not exist.".format(parentid))
+        if childid in path_ids(parentpath):
+            raise MenuTreeError('A menu cannot be moved beneath itself or its descendants.')
+        oldparentid = submenu.parent_id
+        oldparentpath = parent_path(submenu.path)
+        close_ordinal_gap(submenu)
+        # adjust ordinal to put this item at the end.
+        ordinal = next_ordinal(parentid)
+        moved = move_subtree(submenu, parentid, parentpath, parentdepth)
+        submenu.ordinal = ordinal
+        submenu.save()
+        journal.record('move', id=childid, parent=parentid, ordinal=ordinal)
+        if oldparentid != parentid:
+            add_counts(oldparentpath, -1, -(moved + 1))
+            add_counts(parentpath, 1, moved + 1)
+        tree_changed(oldparentid, childid)
+    return submenu.path
+
+def reorder_children(parentid, childids):
+    """
+    Put the children of parentid in the order of the list childids, which
+    must hold each of them exactly once. The current ordinals are read
+    with one query and only the children whose ordinals change are
+    written, by set_ordinals. Returns the list of (child_id, ordinal) pairs.
+    Raises MenuTreeError if childids is not the set of children
+    or holds anything but integer ids.
+    """
+    parentid = int(parentid)
+    for id in childids:
+        if isinstance(id, bool) or not isinstance(id, six.integer_types):
+            raise MenuTreeError('Invalid child id {0!r}.'.format(id))
+    logger.info("api_impl.reorder_children(parentid={0}, {1} children)".format(parentid, len(childids)))
+    gap = ordinal_gap()
+    ordinals = [(id, (index + 1) * gap) for index, id in enumerate(childids)]
+    with transaction.atomic():
+        current = dict(Submenu.objects.filter(parent_id=parentid).values_list('child_id', 'ordinal'))
+        if len(set(childids)) != len(childids) or set(childids) != set(current):
+            raise MenuTreeError('The new order must list each child of the menu exactly once.')
+        changed = [(id, ordinal) for id, ordinal in ordinals if current[id] != ordinal]
+        if not changed:
+            return ordinals
+        set_ordinals(changed)
+        journal.record('order', id=parentid, children=[list(pair) for pair in ordinals])
+        tree_changed(parentid)
+    return ordinals
+
+def delete_subtree(submenu):
+    """
+    Delete the child of submenu together with all of its descendants.
+    The ids are selected by one range scan on the path index and removed with
+    chunked DELETE ... WHERE id IN (...) statements. The later siblings are
+    then moved up with a single UPDATE to close the gap in the ordinals.
+    """
+    with transaction.atomic():
+        # Selected in the transaction, so a child added meanwhile is not left behind.
+        ids = [submenu.child_id]
+        ids.extend(submenus_within(submenu.path).values_list('child_id', flat=True))
+        logger.info("api_impl.delete_subtree(id={0}) deleting {1} items".format(submenu.child_id, len(ids)))
+        chunks = [ids[start:start + DELETE_CHUNK_SIZE] for start in range(0, len(ids), DELETE_CHUNK_SIZE)]
+        with connection.cursor() as cursor:
+            # Remove the links first so no Submenu refers to a deleted Menu.
+            for table, column in (('app_subtreejson', 'menu_id'), ('app_submenu', 'child_id'), ('app_menu', 'id')):
+                for chunk in chunks:
+                    cursor.execute('DELETE FROM {0} WHERE {1} IN ({2})'.format(
+                        table, column, ', '.join(['%s'] * len(chunk))), chunk)
+        journal.record('delete', id=submenu.child_id)
+        close_ordinal_gap(submenu)
+        add_counts(parent_path(submenu.path), -1, -len(ids))
+        tree_changed(submenu.parent_id)
+
+def ordinal_gap():
+    """
+    The spacing between the ordinals of adjacent siblings.
+    1 keeps the ordinals dense (1..N). A larger settings.MENU_ORDINAL_GAP
+    leaves room to insert or move an item by changing only its own ordinal.
+    """
+    return getattr(settings, 'MENU_ORDINAL_GAP', 1)
+
+def set_ordinals(ordinals):
+    """
+    Apply a list of (child_id, ordinal) pairs with one UPDATE ... CASE
+    statement per DELETE_CHUNK_SIZE / 2 pairs.
+    """
+    size = DELETE_CHUNK_SIZE // 2
+    for start in range(0, len(ordinals), size):
+        chunk = ordinals[start:start + size]
+        Submenu.objects.filter(child_id__in=[id for id, ordinal in chunk]).update(
+            ordinal=Case(*[When(child_id=id, then=Value(ordinal)) for id, ordinal in chunk],
+                         output_field=PositiveIntegerField()))
+
+def rebalance_ordinals(parentid):
+    """
+    Respace the ordinals of the children of parentid to multiples of the gap,
+    keeping their order. Only needed once the room between two sparse
+    ordinals has been used up.
+    """
+    logger.info("api_impl.rebalance_ordinals(parentid={0})".format(parentid))
+    gap = ordinal_gap()
+    ids = Submenu.objects.filter(parent=parentid).order_by('ordinal', 'child_id').values_list('child_id', flat=True)
+    set_ordinals([(id, (index + 1) * gap) for index, id in enumerate(ids)])
+    journal.record_order(parentid)
+
+def next_ordinal(parentid):
+    """
+    The ordinal that places a new child of parentid after all the others.
+    """
+    gap = ordinal_gap()
+    last = Submenu.objects.filter(parent=parentid).aggregate(last=Max('ordinal'))['last'] or 0
+    if last + gap > MAX_ORDINAL:
+        rebalance_ordinals(parentid)
+        last = Submenu.objects.filter(parent=parentid).count() * gap
+    return last + gap
+
+def close_ordinal_gap(submenu):
+    """
+    With dense ordinals, move the siblings after the removed submenu up by one.
+    Sparse ordinals are left alone. Legacy children with no ordinal yet are
+    numbered when next viewed.
+    """
+    if ordinal_gap() == 1 and submenu.ordinal > 0:
+        if Submenu.objects.filter(parent_id=submenu.parent_id, ordinal__gt=submenu.ordinal).update(
+                ordinal=F('ordinal') - 1):
+            journal.record('shift', id=submenu.parent_id, after=submenu.ordinal)
+
+def move_child(submenu, step):
+    """
+    Move submenu one place later (step=1) or earlier (step=-1) among its siblings.
+    Dense ordinals swap with the neighbour. Sparse ordinals only change submenu,
+    taking a value between the neighbour and the sibling beyond it.
+    Returns False if submenu is already the last (or first) child.
+    """
+    if Submenu.objects.filter(parent_id=submenu.parent_id, ordinal=0).exists():
+        initialise_ordinals_of(submenu.parent_id)
+        submenu.refresh_from_db()
+    siblings = Submenu.objects.filter(parent_id=submenu.parent_id)
+    if step > 0:
+        siblings = siblings.filter(Q(ordinal__gt=submenu.ordinal) |
+                                   Q(ordinal=submenu.ordinal, child_id__gt=submenu.child_id))
+        siblings = siblings.order_by('ordinal', 'child_id')
+    else:
+        siblings = siblings.filter(Q(ordinal__lt=submenu.ordinal) |
+                                   Q(ordinal=submenu.ordinal, child_id__lt=submenu.child_id))
+        siblings = siblings.order_by('-ordinal', '-child_id')
+    neighbours = list(siblings.values_list('child_id', 'ordinal')[:2])
+    if not neighbours:
+        return False
+
+    gap = ordinal_gap()
+    nearid, near = neighbours[0]
+    if gap == 1:
+        Submenu.objects.filter(child_id=nearid).update(ordinal=submenu.ordinal)
+        journal.record_many('move', [{'id': nearid, 'parent': submenu.parent_id, 'ordinal': submenu.ordinal},
+                                     {'id': submenu.child_id, 'parent': submenu.parent_id, 'ordinal': near}])
+        submenu.ordinal = near
+        submenu.save(update_fields=['ordinal'])
+        return True
+
+    if len(neighbours) > 1:
+        far = neighbours[1][1]
+    else:
+        far = near + 2 * gap if step > 0 else 0
+    ordinal = (near + far) // 2
+    if abs(far - near) < 2 or ordinal > MAX_ORDINAL:
+        # No room left between the neighbours.
+        rebalance_ordinals(submenu.parent_id)
+        submenu.refresh_from_db()
+        return move_child(submenu, step)
+    submenu.ordinal = ordinal
+    submenu.save(update_fields=['ordinal'])
+    journal.record('move', id=submenu.child_id, parent=submenu.parent_id, ordinal=ordinal)
+    return True
+
+def initialise_ordinals(children):
     '''
     Set the ordinal values of the children (list of ChildMenu objects) if they are currently 0.
     Usually generated by a call to gather_children.
-    Returns the length of children, which corresponds to the last ordinal value.
-    If startat is not zero, skip children[0:startat]
+    Returns the length of children, which corresponds to the last ordinal value
+    when the ordinals are dense.
     '''
     logger.info("api_impl.initialise_ordinals(children)")
+    gap = ordinal_gap()
     ordinal = 1
-    if startat > 0:
-        ordinal = startat
-        children = children[ordinal-1:]
+    changed = False
     # Iterate over children setting ordinal value
     with transaction.atomic():
         for child in children:
+            # The ordinal is already known, so avoid the lookup if it is set.
+            if child.ordinal != 0:
+                break
             submenu = Submenu.objects.get(child=child.id)
-            # Stop if this a default initialisation is detected
-            # and not a delete operation.
-            if submenu.ordinal != 0 and startat == 0:
+            # Stop if this a default initialisation is detected.
+            if submenu.ordinal != 0:
                 break
             else:
-                child.ordinal = ordinal
-                submenu.ordinal = ordinal
+                child.ordinal = ordinal * gap
+                submenu.ordinal = ordinal * gap
                 submenu.save()
                 ordinal = ordinal + 1
+                changed = True
+        if changed:
+            journal.record_order(children[0].parentid)
+            tree_changed(children[0].parentid)
     return len(children)
 
-def initialise_ordinals_of(parentid, startat=0):
-    # Gthe children of this menu's parent and
+def initialise_ordinals_of(parentid):
+    # Get the children of this menu's parent and
     # set ordinal values if they are 0.
-    initialise_ordinals(gather_children(parentid), startat=startat)
+    initialise_ordinals(gather_children(parentid))
 
 def dictFromTree(tree):
-    submenu = []
-    for branch in tree.branches:
-        submenu.append(dictFromTree(branch))
-
-    response = {
-        'id': tree.id,
-        'name': tree.name,
-        'ordinal': tree.ordinal,
-        'submenu': submenu
-        }
-    return response
+    """
+    Convert a Tree into nested dictionaries suitable for a JSON response.
+    Nodes are converted in post-order so each one's children are ready first.
+    """
+    converted = {}
+    for node, parent, level in traversal.walk(tree, branches, order=traversal.POSTORDER):
+        converted[id(node)] = {
+            'id': node.id,
+            'name': node.name,
+            'ordinal': node.ordinal,
+            'submenu': [converted.pop(id(branch)) for branch in node.branches]
+            }
+    return converted[id(tree)]
 
-def menu_get(parentid, depth):
+def menu_get(parentid, depth, stream=False):
     """
     Construct a JSON response describing the tree starting at node parentid
     and proceeding to depth levels of children.
+    depth: None or -1 == all levels.
+    stream: Emit the JSON while walking the tree rather than building it first.
+    With the in-process replica enabled the tree is read from it, without a
+    database query, and the JSON fragment cache is not used.
     """
-    # Don't count the root node. Set count to -1 initially.
-    report = { 'tree': None, 'count': -1 }
-    # build_tree_from only updates the count member.
-    tree = build_tree(report, id=1, depth=depth)
-    report['tree'] = tree
+    try:
+        depth = -1 if depth in (None, '') else int(depth)
+    except ValueError:
+        raise Http404("Invalid depth: '{0}'".format(depth))
+    if stream:
+        if replica.enabled():
+            rows = replica.current().subtree_preorder(int(parentid), depth)
+        else:
+            rows = iter_subtree(int(parentid), depth)
+        try:
+            first = next(rows)
+        except StopIteration:
+            raise Http404("Invalid menu: '{0}'".format(parentid))
+        return StreamingHttpResponse(iter_tree_json(itertools.chain([first], rows)),
+                                     content_type='application/json')
+    if jsoncache.enabled() and not replica.enabled():
+        content = jsoncache.subtree_json(int(parentid), depth)
+        if content is None:
+            raise Http404("Invalid menu: '{0}'".format(parentid))
+        return HttpResponse(content, content_type='application/json')
+    tree = load_compact_tree(int(parentid), depth)
+    if tree is None:
+        raise Http404("Invalid menu: '{0}'".format(parentid))
     # Traverse tree and build the required dictionary.
-    response = dictFromTree(tree)
+    response = tree.to_dict()
     return JsonResponse(response)
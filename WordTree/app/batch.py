@@ -0,0 +1,271 @@
+"""
+Batches of tree edits applied in one transaction.
+
+A batch is an ordered list of operations:
+
+    {"op": "add", "parent": 5, "name": "Soup", "tmp": "soup"}
+    {"op": "rename", "id": 42, "name": "Leek soup"}
+    {"op": "move", "id": 42, "step": 1}        one place later (-1 earlier)
+    {"op": "change_parent", "id": 42, "parent": 7}
+    {"op": "delete", "id": 42}
+    {"op": "reorder", "parent": 5, "children": [42, 40, 41]}
+
+An add may name its new item with a temporary id, a string chosen by the
+client, which later operations of the batch can use in place of an id.
+
+The operations are applied in order inside one transaction, and either
+all of them take effect or, if one fails, none do. Runs of consecutive
+adds, and of consecutive renames, are written together: the adds with
+one bulk insert per table, the renames with one UPDATE. tree_changed is
+deferred to the end, so each changed item is bumped once per batch.
+"""
+
+from django.db import transaction
+from django.db.models import Case, Max, Value, When, CharField
+from django.utils import six
+
+import collections
+import itertools
+import logging
+
+from app.models import Menu, Submenu
+import app.api_impl as api
+import app.journal as journal
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_SIZE = 1000
+
+# The permissions needed for each operation, as the views require them.
+PERMISSIONS = {
+    'add': ['app.add_menu', 'app.add_submenu'],
+    'rename': ['app.change_menu'],
+    'move': ['app.change_menu', 'app.change_submenu'],
+    'change_parent': ['app.change_submenu'],
+    'delete': ['app.delete_menu', 'app.delete_submenu'],
+    'reorder': ['app.change_submenu'],
+    }
+
+# Operations written together when they follow one another.
+GROUPED = ('add', 'rename')
+
+class BatchError(api.MenuTreeError):
+    """
+    An operation of a batch is invalid or failed; index is its position.
+    """
+    def __init__(self, index, message):
+        super(BatchError, self).__init__('Operation {0}: {1}'.format(index, message))
+        self.index = index
+
+def permissions(operations):
+    """
+    The permissions needed to apply the operations.
+    """
+    needed = set()
+    for operation in operations:
+        needed.update(PERMISSIONS.get(operation.get('op') if isinstance(operation, dict) else None, []))
+    return sorted(needed)
+
+class Batch(object):
+    """
+    The state of a batch being applied: the ids of the items created so far
+    by temporary id.
+    """
+    def __init__(self):
+        self.created = {}
+
+    def resolve(self, index, value):
+        """
+        The menu id given by value, an id or the temporary id of a new item.
+        """
+        if isinstance(value, bool) or not isinstance(value, six.integer_types + six.string_types):
+            raise BatchError(index, 'Invalid id {0!r}.'.format(value))
+        if isinstance(value, six.integer_types):
+            return value
+        if value in self.created:
+            return self.created[value]
+        raise BatchError(index, 'Unknown id {0!r}.'.format(value))
+
+    def add(self, operations):
+        """
+        Create the items of a run of (index, operation) adds with one bulk
+        insert per table. Parents created earlier in the run are known from
+        the run; the paths, depths and last ordinals of the others are read
+        with one query each.
+        """
+        gap = api.ordinal_gap()
+        # [parent id or None, parent's position in items or None, name, operation index]
+        items = []
+        bytmp = {}
+        for index, operation in operations:
+            name = operation.get('name')
+            try:
+                api.check_menu_name(name)
+            except api.MenuTreeError as e:
+                raise BatchError(index, str(e))
+            parent = operation.get('parent')
+            if isinstance(parent, six.string_types) and parent in bytmp:
+                items.append([None, bytmp[parent], name, index])
+            else:
+                items.append([self.resolve(index, parent), None, name, index])
+            tmp = operation.get('tmp')
+            if tmp is not None:
+                if not isinstance(tmp, six.string_types) or tmp in self.created or tmp in bytmp:
+                    raise BatchError(index, 'Invalid or repeated temporary id {0!r}.'.format(tmp))
+                bytmp[tmp] = len(items) - 1
+
+        parentids = set(item[0] for item in items if item[0] is not None)
+        parents = dict((id, (path or '/{0}/'.format(id), depth or 0)) for id, path, depth in
+                       Menu.objects.filter(id__in=parentids).values_list('id', 'children__path', 'children__depth'))
+        lastordinals = dict(Submenu.objects.filter(parent_id__in=parentids).values('parent_id')
+                            .annotate(last=Max('ordinal')).values_list('parent_id', 'last'))
+        # Respace the children of a parent whose new ordinals would not fit
+        # before any are handed out, so the run keeps its order.
+        for parentid, count in collections.Counter(item[0] for item in items if item[0] in parents).items():
+            if (lastordinals.get(parentid) or 0) + count * gap > api.MAX_ORDINAL:
+                api.rebalance_ordinals(parentid)
+                lastordinals[parentid] = Submenu.objects.filter(parent_id=parentid).count() * gap
+
+        # Depths and ordinals of the new items, and the counts they add.
+        depths = []
+        ordinals = []
+        nextordinal = {}
+        children = {}
+        descendants = {}
+        newchildren = [0] * len(items)
+        newdescendants = [0] * len(items)
+        for position, (parentid, parentitem, name, index) in enumerate(items):
+            if parentitem is not None:
+                depth = depths[parentitem] + 1
+                key = ('new', parentitem)
+                ordinal = nextordinal.get(key, 0) + gap
+            else:
+                if parentid not in parents:
+                    raise BatchError(index, 'There is no menu {0}.'.format(parentid))
+                depth = parents[parentid][1] + 1
+                key = parentid
+                ordinal = nextordinal.get(key, lastordinals.get(parentid) or 0) + gap
+            if depth >= api.MAX_MENU_DEPTH:
+                raise BatchError(index, 'Menus cannot be nested more than {0} levels deep.'.format(api.MAX_MENU_DEPTH))
+            nextordinal[key] = ordinal
+            depths.append(depth)
+            ordinals.append(ordinal)
+            # Count the new item in each of its ancestors.
+            ancestor, first = position, True
+            while True:
+                ancestorparent, ancestoritem = items[ancestor][0], items[ancestor][1]
+                if ancestoritem is None:
+                    for id in api.path_ids(parents[ancestorparent][0]):
+                        descendants[id] = descendants.get(id, 0) + 1
+                    if first:
+                        children[ancestorparent] = children.get(ancestorparent, 0) + 1
+                    break
+                newdescendants[ancestoritem] += 1
+                if first:
+                    newchildren[ancestoritem] += 1
+                ancestor, first = ancestoritem, False
+
+        ids = api.bulk_create_menus([Menu(name=item[2], data='', child_count=childcount, descendant_count=descendantcount)
+                                     for item, childcount, descendantcount in zip(items, newchildren, newdescendants)])
+        paths = []
+        submenus = []
+        for (parentid, parentitem, name, index), id, depth, ordinal in zip(items, ids, depths, ordinals):
+            if parentitem is not None:
+                parentid, parentpath = ids[parentitem], paths[parentitem]
+            else:
+                parentpath = parents[parentid][0]
+            paths.append('{0}{1}/'.format(parentpath, id))
+            submenus.append(Submenu(parent_id=parentid, child_id=id, ordinal=ordinal, path=paths[-1], depth=depth))
+        Submenu.objects.bulk_create(submenus)
+        api.apply_counts(children, descendants)
+        journal.record_many('add', [{'id': submenu.child_id, 'parent': submenu.parent_id, 'ordinal': submenu.ordinal, 'name': item[2]}
+                                    for submenu, item in zip(submenus, items)])
+        for tmp, position in bytmp.items():
+            self.created[tmp] = ids[position]
+        api.tree_changed(*ids)
+
+    def rename(self, operations):
+        """
+        Rename the items of a run of (index, operation) renames with one UPDATE.
+        """
+        names = []
+        for index, operation in operations:
+            try:
+                api.check_menu_name(operation.get('name'))
+            except api.MenuTreeError as e:
+                raise BatchError(index, str(e))
+            names.append((self.resolve(index, operation.get('id')), operation['name'], index))
+        existing = set(Menu.objects.filter(id__in=[id for id, name, index in names]).values_list('id', flat=True))
+        for id, name, index in names:
+            if id not in existing:
+                raise BatchError(index, 'There is no menu {0}.'.format(id))
+        # The last of several renames of one item wins, as it would in turn.
+        final = dict((id, name) for id, name, index in names)
+        Menu.objects.filter(id__in=final).update(
+            name=Case(*[When(id=id, then=Value(name)) for id, name in final.items()], output_field=CharField()))
+        journal.record_many('edit', [{'id': id, 'name': name} for id, name, index in names])
+        api.tree_changed(*final)
+
+    def apply(self, index, operation):
+        """
+        Apply one operation that is not grouped with others.
+        """
+        kind = operation['op']
+        if kind == 'move':
+            step = operation.get('step')
+            if step not in (1, -1):
+                raise BatchError(index, 'step must be 1 or -1.')
+            submenu = Submenu.objects.get(child=self.resolve(index, operation.get('id')))
+            api.move_child(submenu, step)
+            api.tree_changed(submenu.parent_id)
+        elif kind == 'change_parent':
+            api.change_parent(self.resolve(index, operation.get('id')), self.resolve(index, operation.get('parent')))
+        elif kind == 'delete':
+            api.delete_subtree(Submenu.objects.get(child=self.resolve(index, operation.get('id'))))
+        elif kind == 'reorder':
+            childids = operation.get('children')
+            if not isinstance(childids, list):
+                raise BatchError(index, 'children must be a list.')
+            api.reorder_children(self.resolve(index, operation.get('parent')),
+                                 [self.resolve(index, id) for id in childids])
+
+def run(operations):
+    """
+    Apply the list of operations in one transaction. Returns a dictionary
+    of the ids of the new items by temporary id.
+    Raises BatchError, rolling back the whole batch, if an operation fails.
+    """
+    if not isinstance(operations, list):
+        raise api.MenuTreeError('A batch must be a list of operations.')
+    if len(operations) > MAX_BATCH_SIZE:
+        raise api.MenuTreeError('A batch can hold at most {0} operations.'.format(MAX_BATCH_SIZE))
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in PERMISSIONS:
+            raise BatchError(index, 'Unknown operation.')
+    logger.info("batch.run() applying {0} operations".format(len(operations)))
+
+    batch = Batch()
+    def kind(pair):
+        op = pair[1]['op']
+        # Ungrouped operations each form a group of their own.
+        return op if op in GROUPED else (op, pair[0])
+
+    with transaction.atomic():
+        with api.deferred_tree_changes():
+            for key, group in itertools.groupby(enumerate(operations), key=kind):
+                group = list(group)
+                if key == 'add':
+                    batch.add(group)
+                elif key == 'rename':
+                    batch.rename(group)
+                else:
+                    index, operation = group[0]
+                    try:
+                        batch.apply(index, operation)
+                    except BatchError:
+                        raise
+                    except api.MenuTreeError as e:
+                        raise BatchError(index, str(e))
+                    except (Menu.DoesNotExist, Submenu.DoesNotExist):
+                        raise BatchError(index, 'There is no such menu, or it cannot be changed.')
+    return batch.created
@@ -0,0 +1,189 @@
+"""
+Benchmarks of the menu tree hot paths.
+
+synthetic_items() describes a tree of a given width, depth and skew in the
+nested form accepted by api_impl.menu_bulk_add, so that large trees can be
+generated quickly. run() builds such a tree beneath the root menu and
+measures each operation for wall time, number of SQL queries and peak
+Python memory (tracemalloc). The peak memory is only measured on Python 3,
+which has tracemalloc; on Python 2 it is None and the times come from
+time.time() rather than time.perf_counter().
+
+run() works on whatever database is current. The benchmark management
+command runs it against a freshly created test database.
+"""
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+
+import gc
+import time
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+from app.models import Menu, Submenu
+import app.api_impl as api
+
+timer = getattr(time, 'perf_counter', time.time)
+
+def child_count(width, skew, position):
+    """
+    The number of children of the node at position among its siblings.
+    With skew 0 every node has width children. A larger skew gives the
+    earlier siblings more children than the later ones, down to none.
+    """
+    return int(round(width * (1.0 - skew) ** position))
+
+def synthetic_items(width, depth, skew=0.0, prefix='N'):
+    """
+    Returns a list of width nested items, depth levels deep, for menu_bulk_add.
+    Names are the prefix followed by the item's position at each level,
+    e.g. N.1.3 is the third child of the first item.
+    """
+    top = []
+    pending = [(top, prefix, width, 1)]
+    while pending:
+        items, name, count, level = pending.pop()
+        for position in range(count):
+            item = { 'name': '{0}.{1}'.format(name, position + 1), 'submenu': [] }
+            items.append(item)
+            if level < depth:
+                pending.append((item['submenu'], item['name'], child_count(width, skew, position), level + 1))
+    return top
+
+def count_items(items):
+    """
+    The total number of items in a synthetic_items() list.
+    """
+    total = 0
+    pending = list(items)
+    while pending:
+        item = pending.pop()
+        total += 1
+        pending.extend(item['submenu'])
+    return total
+
+def generate_tree(parentid, width, depth, skew=0.0):
+    """
+    Adds a synthetic tree beneath the menu parentid and returns the new ids
+    in pre-order.
+    """
+    return api.menu_bulk_add(parentid, synthetic_items(width, depth, skew))
+
+def measure(operation, repeat=3, rollback=False):
+    """
+    Calls operation() repeat times and returns a dictionary of the wall times,
+    their minimum and median, the number of SQL queries of one call and
+    the peak memory allocated during an extra call traced by tracemalloc,
+    or None without tracemalloc.
+    With rollback=True each call is made inside a transaction that is then
+    rolled back, so operations that change the tree always start from the
+    same tree.
+    """
+    def call():
+        if rollback:
+            with transaction.atomic():
+                operation()
+                transaction.set_rollback(True)
+        else:
+            operation()
+
+    seconds = []
+    queries = 0
+    for run in range(repeat):
+        gc.collect()
+        with CaptureQueriesContext(connection) as context:
+            start = timer()
+            call()
+            seconds.append(timer() - start)
+        queries = len(context.captured_queries)
+
+    peak = None
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            call()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    ordered = sorted(seconds)
+    return {
+        'seconds': seconds,
+        'min': ordered[0],
+        'median': ordered[len(ordered) // 2],
+        'queries': queries,
+        'peak_bytes': peak,
+        }
+
+def run(width=10, depth=3, skew=0.0, repeat=3):
+    """
+    Generates a synthetic tree beneath the root menu and benchmarks the hot
+    paths against it. Returns a dictionary ready to be written as JSON.
+    The views are driven through the test Client as a logged in superuser.
+    """
+    if width < 2 or depth < 2:
+        raise ValueError('The benchmark tree needs a width and a depth of at least 2.')
+
+    root, created = Menu.objects.get_or_create(id=1, defaults={ 'name': 'RU App', 'data': '' })
+    start = timer()
+    generate_tree(root.id, width, depth, skew)
+    generated = timer() - start
+
+    user = User.objects.filter(username='benchmark').first() or \
+        User.objects.create_superuser('benchmark', 'benchmark@example.com', 'benchmark')
+    client = Client()
+    client.force_login(user)
+
+    children = api.gather_children(root.id)
+    first, middle, last = children[0], children[len(children) // 2], children[-1]
+    # A child of the first top level item, to be moved beneath the last one.
+    moved = api.gather_children(first.id)[0]
+
+    def menu_url(*ids):
+        return '/menu/{0}/'.format('/'.join(str(id) for id in (root.id,) + ids))
+
+    def stream():
+        response = api.menu_get(root.id, -1, stream=True)
+        return b''.join(response.streaming_content)
+
+    def cached():
+        with override_settings(TREE_JSON_CACHE=True):
+            return api.menu_get(root.id, -1)
+
+    operations = [
+        ('menu_get', lambda: api.menu_get(root.id, -1), False),
+        ('menu_get_cached', cached, False),
+        ('menu_get_stream', stream, False),
+        ('build_report', api.build_report, False),
+        ('gather_children', lambda: api.gather_children(root.id), False),
+        ('menu_page', lambda: client.get(menu_url()), False),
+        ('menu_delete', lambda: client.get(menu_url(last.id) + 'delete/'), True),
+        ('move_next', lambda: client.get(menu_url(middle.id) + 'move_next/'), True),
+        ('move_prev', lambda: client.get(menu_url(middle.id) + 'move_prev/'), True),
+        ('change_parent', lambda: client.post(menu_url(first.id, moved.id) + 'change_parent/',
+            { 'id': moved.id, 'name': moved.name, 'parentid': last.id }), True),
+        ]
+
+    results = {}
+    for name, operation, rollback in operations:
+        results[name] = measure(operation, repeat=repeat, rollback=rollback)
+
+    return {
+        'vendor': connection.vendor,
+        'tree': {
+            'width': width,
+            'depth': depth,
+            'skew': skew,
+            'nodes': Submenu.objects.count() + 1,
+            'generate_seconds': generated,
+            },
+        'repeat': repeat,
+        'results': results,
+        }
@@ -0,0 +1,175 @@
+"""
+Compact array-backed tree.
+
+A CompactTree holds a subtree in pre-order as parallel arrays rather than
+one Python object per node:
+
+    ids[i]       menu item id
+    ordinals[i]  Submenu ordinal (0 for the root)
+    levels[i]    levels below the root of the subtree
+    parents[i]   index of the parent node, -1 for the root
+    ends[i]      index one past the last descendant of node i
+    names[i]     from a StringTable, all the names in a single string
+
+Because the layout is pre-order the descendants of node i are exactly the
+range i+1 .. ends[i]-1, and its children are found by hopping from one
+sibling's end to the next.
+"""
+
+from array import array
+
+import app.traversal as traversal
+
+class StringTable(object):
+    """
+    A sequence of strings stored end to end in one string with an offset array.
+    With an encoding, text is a bytes-like pool (e.g. a memoryview of a mapped
+    file) and each string is decoded as it is read.
+    """
+    __slots__ = ('text', 'offsets', 'encoding')
+
+    def __init__(self, text, offsets, encoding=None):
+        self.text = text
+        self.offsets = offsets
+        self.encoding = encoding
+
+    @classmethod
+    def from_strings(cls, strings):
+        offsets = array('l', [0])
+        for string in strings:
+            offsets.append(offsets[-1] + len(string))
+        return cls(''.join(strings), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        value = self.text[self.offsets[index]:self.offsets[index + 1]]
+        if self.encoding:
+            return bytes(value).decode(self.encoding)
+        return value
+
+class CompactTree(object):
+    """
+    A subtree held in parallel arrays in pre-order. See the module docstring.
+    Node 0 is the root of the subtree.
+    """
+    __slots__ = ('ids', 'ordinals', 'levels', 'parents', 'ends', 'names')
+
+    def __init__(self, ids, ordinals, levels, parents, ends, names):
+        self.ids = ids
+        self.ordinals = ordinals
+        self.levels = levels
+        self.parents = parents
+        self.ends = ends
+        self.names = names
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Build a CompactTree from the pre-order (id, ordinal, level, name) rows
+        of api_impl.iter_subtree. Returns None if there are no rows.
+        """
+        ids = array('q')
+        ordinals = array('l')
+        levels = array('h')
+        parents = array('l')
+        ends = array('l')
+        names = []
+        # Indexes of the ancestors of the current node.
+        ancestors = []
+        for index, (id, ordinal, level, name) in enumerate(rows):
+            while ancestors and levels[ancestors[-1]] >= level:
+                ends[ancestors.pop()] = index
+            ids.append(id)
+            ordinals.append(ordinal)
+            levels.append(level)
+            parents.append(ancestors[-1] if ancestors else -1)
+            ends.append(0)
+            names.append(name)
+            ancestors.append(index)
+        if not ids:
+            return None
+        for index in ancestors:
+            ends[index] = len(ids)
+        return cls(ids, ordinals, levels, parents, ends, StringTable.from_strings(names))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def children(self, index):
+        """
+        Yields the indexes of the children of node index.
+        """
+        child = index + 1
+        end = self.ends[index]
+        while child < end:
+            yield child
+            child = self.ends[child]
+
+    def walk(self, order=traversal.PREORDER, depth=-1):
+        """
+        Yields (index, parent index, level) triples as traversal.walk.
+        """
+        return traversal.walk(0, self.children, order=order, depth=depth)
+
+    def rows(self, index=0, depth=-1):
+        """
+        Yields the pre-order (id, ordinal, level, name) rows of the subtree
+        at node index, to depth levels below it (-1 == all), i.e. the input
+        of from_rows and of api_impl.iter_tree_json. Levels count from the
+        subtree's root, as in PREORDER_SQL.
+        """
+        base = self.levels[index]
+        for node in range(index, self.ends[index]):
+            level = self.levels[node] - base
+            if depth < 0 or level <= depth:
+                yield self.ids[node], self.ordinals[node], level, self.names[node]
+
+    def node(self, index=0):
+        """
+        A Tree-like view of node index, e.g. for templates.
+        """
+        return CompactNode(self, index)
+
+    def to_dict(self):
+        """
+        The nested dictionaries of api_impl.dictFromTree.
+        In reverse pre-order every node comes after all of its children.
+        """
+        converted = {}
+        for index in reversed(range(len(self.ids))):
+            converted[index] = {
+                'id': self.ids[index],
+                'name': self.names[index],
+                'ordinal': self.ordinals[index],
+                'submenu': [converted.pop(child) for child in self.children(index)]
+                }
+        return converted[0]
+
+class CompactNode(object):
+    """
+    A lightweight view of one node of a CompactTree with the attributes
+    of api_impl.Tree, created on demand.
+    """
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def id(self):
+        return self.tree.ids[self.index]
+
+    @property
+    def name(self):
+        return self.tree.names[self.index]
+
+    @property
+    def ordinal(self):
+        return self.tree.ordinals[self.index]
+
+    @property
+    def branches(self):
+        return [CompactNode(self.tree, child) for child in self.tree.children(self.index)]
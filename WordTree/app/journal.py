@@ -0,0 +1,125 @@
+"""
+Journal of changes to the menu tree.
+
+Every write to the tree appends Change records, in the same transaction,
+describing its effect as deltas that a client mirroring the tree can apply
+in sequence order:
+
+    add      {"id": 42, "parent": 5, "ordinal": 3, "name": "Soup"}
+    edit     {"id": 42, "name": "Leek soup"}
+    delete   {"id": 42}  the item and all of its descendants
+    move     {"id": 42, "parent": 7, "ordinal": 2}  with all its descendants
+    order    {"id": 5, "children": [[41, 1], [42, 2]]}  the new ordinals
+             of the children of item 5
+    shift    {"id": 5, "after": 3}  the children of item 5 with ordinals
+             above 3 move up by one (a gap closed in dense ordinals)
+    import   {"items": [[42, 5, 3, "Soup"], [43, 42, 1, "Leek"]]}  adds of
+             [id, parent, ordinal, name], parents first; one entry for each
+             batch written by transfer.import_tree
+
+Moving an item among its siblings is journalled as a move of each item
+whose ordinal changed, so an entry's size follows the edit rather than
+the number of siblings; only rebalancing and reordering record all of them.
+
+A client downloads the tree with menu_get after noting the latest sequence
+number, then polls for the changes since then. Adds are best applied as
+upserts, as changes made during the download are seen again.
+
+compact() trims the journal. It keeps the newest trimmed entry as a
+COMPACTED marker, so a client asking for changes from before the marker
+can be told that they are no longer available and that it must download
+the tree again.
+"""
+
+from django.db import connection
+from django.db.models import Max
+
+import json
+import logging
+
+from app.models import Change, Submenu
+
+logger = logging.getLogger(__name__)
+
+CHANGES_PAGE_SIZE = 500
+MAX_CHANGES_PAGE_SIZE = 5000
+
+COMPACTED = 'compacted'
+
+class JournalCompacted(Exception):
+    """
+    The changes asked for have been trimmed from the journal.
+    """
+
+def lock():
+    """
+    On PostgreSQL hold the journal's lock until the transaction ends, so that
+    the entries are committed in the order of their sequence numbers and a
+    reader can never skip over one committed late. SQLite has only one
+    writer at a time anyway.
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('LOCK TABLE app_change IN EXCLUSIVE MODE')
+
+def record(action, **data):
+    """
+    Append one change. Must be called inside the transaction of the write.
+    """
+    lock()
+    Change.objects.create(action=action, data=json.dumps(data))
+
+def record_many(action, deltas):
+    """
+    Append a change for each of the delta dictionaries, in order.
+    Must be called inside the transaction of the write.
+    """
+    if deltas:
+        lock()
+        Change.objects.bulk_create([Change(action=action, data=json.dumps(delta)) for delta in deltas])
+
+def record_order(parentid):
+    """
+    Append the current ordinals of the children of parentid.
+    Must be called inside the transaction of the write.
+    """
+    children = Submenu.objects.filter(parent_id=parentid).order_by('ordinal', 'child_id').values_list('child_id', 'ordinal')
+    record('order', id=parentid, children=[list(child) for child in children])
+
+def latest():
+    """
+    The sequence number of the newest change, 0 if there are none.
+    """
+    return Change.objects.aggregate(latest=Max('id'))['latest'] or 0
+
+def changes(since, limit=CHANGES_PAGE_SIZE):
+    """
+    Returns up to limit changes made after sequence number since, oldest first,
+    as dictionaries with their seq and action added to their deltas, and
+    whether any more changes follow them.
+    Raises JournalCompacted if changes after since have been trimmed.
+    """
+    oldest = Change.objects.order_by('id').values_list('id', 'action').first()
+    if oldest is not None and oldest[1] == COMPACTED and since < oldest[0]:
+        raise JournalCompacted('Changes up to {0} are no longer available.'.format(oldest[0]))
+    entries = list(Change.objects.filter(id__gt=since).exclude(action=COMPACTED).order_by('id')
+                   .values_list('id', 'action', 'data')[:limit + 1])
+    deltas = []
+    for seq, action, data in entries[:limit]:
+        delta = json.loads(data)
+        delta.update(seq=seq, action=action)
+        deltas.append(delta)
+    return deltas, len(entries) > limit
+
+def compact(before):
+    """
+    Trim the changes made before the datetime before, leaving a marker in
+    place of the newest of them. Returns the number of changes removed.
+    """
+    horizon = Change.objects.filter(created__lt=before).aggregate(horizon=Max('id'))['horizon']
+    if horizon is None:
+        return 0
+    removed, counts = Change.objects.filter(id__lt=horizon).delete()
+    Change.objects.filter(id=horizon).update(action=COMPACTED, data='{}')
+    logger.info("journal.compact() removed {0} changes up to {1}".format(removed, horizon))
+    return removed
@@ -0,0 +1,122 @@
+"""
+Cache of serialized subtree JSON.
+
+menu_get responses are assembled from fragments kept in the SubtreeJson
+table. The fragment of a menu item at depth d is the text of its submenu
+list to d levels, i.e. the JSON objects of its children joined by ', ',
+each containing its own children's fragment at depth d-1 (-1 == all levels).
+
+A fragment is valid while its version equals the version of its menu item.
+tree_changed bumps the version of every changed item and of its ancestors,
+and deletes their fragments once the change commits, so a change to a subtree invalidates exactly
+the fragments that contain it. A child's name and ordinal are part of its
+parent's fragment, and a change to either bumps the parent.
+
+A request looks up the fragments of the requested item, then of the
+children of each item that missed, one level at a time, and rebuilds
+only the missing fragments from their children's. So a request for an
+unchanged subtree runs two queries and serializes nothing, and after a
+change only the changed item and its ancestors are serialized again.
+The cache holds each item's text once for every ancestor (at most
+MAX_MENU_DEPTH times).
+
+Every miss writes fragments, so on SQLite a read takes the write lock.
+The cache is only used when settings.TREE_JSON_CACHE is True.
+"""
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+import json
+import logging
+
+from app.models import Menu, Submenu, SubtreeJson
+
+logger = logging.getLogger(__name__)
+
+# Menu ids per IN (...) lookup, below SQLite's limit on query parameters.
+LOOKUP_CHUNK_SIZE = 500
+
+def enabled():
+    return getattr(settings, 'TREE_JSON_CACHE', False)
+
+def chunks(ids):
+    return [ids[start:start + LOOKUP_CHUNK_SIZE] for start in range(0, len(ids), LOOKUP_CHUNK_SIZE)]
+
+def node_json(id, name, ordinal, fragment):
+    """
+    The JSON text of one node of api_impl.dictFromTree, with its submenu
+    list given as a fragment.
+    """
+    return '{{"id": {0}, "name": {1}, "ordinal": {2}, "submenu": [{3}]}}'.format(id, json.dumps(name), ordinal, fragment)
+
+def invalidate(menuids):
+    """
+    Delete the fragments of the given menu items. Called by tree_changed.
+    """
+    SubtreeJson.objects.filter(menu_id__in=menuids).delete()
+
+def subtree_json(menuid, depth=-1):
+    """
+    Returns the JSON text of the subtree rooted at menuid to depth levels
+    (-1 == all), as api_impl.dictFromTree, or None if there is no such item.
+    """
+    menuid = int(menuid)
+    found = list(Menu.objects.filter(id=menuid).values_list('name', 'version', 'children__ordinal'))
+    if not found:
+        return None
+    name, version, ordinal = found[0]
+
+    versions = {menuid: version}
+    fragments = {}
+    # parent id: [(child id, ordinal, name)] in display order
+    children = {}
+    # (depth, ids) of the items whose fragments are rebuilt, top level first.
+    missed = []
+    # Whether an item has children is read from Submenu, not from the
+    # denormalized counts, so a count that has drifted cannot hide a subtree.
+    # A leaf's fragment is empty, and is cached like any other.
+    frontier = [menuid] if depth != 0 else []
+    while frontier:
+        stale = []
+        for chunk in chunks(frontier):
+            for id, fragmentversion, text in SubtreeJson.objects.filter(
+                    menu_id__in=chunk, depth=depth).values_list('menu_id', 'version', 'json'):
+                if fragmentversion == versions[id]:
+                    fragments[id] = text
+                else:
+                    # Written by a reader that raced with a change.
+                    stale.append(id)
+        if stale:
+            SubtreeJson.objects.filter(menu_id__in=stale, depth=depth).delete()
+        misses = [id for id in frontier if id not in fragments]
+        missed.append((depth, misses))
+
+        childdepth = depth - 1 if depth > 0 else -1
+        frontier = []
+        for chunk in chunks(misses):
+            for parentid, childid, childordinal, childname, childversion in Submenu.objects.filter(
+                    parent_id__in=chunk).order_by('parent_id', 'ordinal', 'child_id').values_list(
+                    'parent_id', 'child_id', 'ordinal', 'child__name', 'child__version'):
+                children.setdefault(parentid, []).append((childid, childordinal, childname))
+                versions[childid] = childversion
+                if childdepth != 0:
+                    frontier.append(childid)
+        depth = childdepth
+
+    # Deepest first, so the fragments of the children are ready.
+    new = []
+    for fragmentdepth, misses in reversed(missed):
+        for id in misses:
+            fragments[id] = ', '.join(node_json(childid, childname, childordinal, fragments.get(childid, ''))
+                                      for childid, childordinal, childname in children.get(id, ()))
+            new.append(SubtreeJson(menu_id=id, depth=fragmentdepth, version=versions[id], json=fragments[id]))
+    if new:
+        try:
+            with transaction.atomic():
+                SubtreeJson.objects.bulk_create(new)
+        except IntegrityError:
+            # Another request stored them first.
+            pass
+        logger.info("jsoncache.subtree_json(menuid={0}) stored {1} fragments".format(menuid, len(new)))
+    return node_json(menuid, name, ordinal or 0, fragments.get(menuid, ''))
@@ -0,0 +1,73 @@
+"""
+Benchmark the menu tree hot paths against a synthetic tree.
+The benchmark runs in a freshly created test database, so it never touches
+the real menus, and writes its results to a JSON file so that runs can be
+compared across releases.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+import django
+
+import json
+import platform
+
+import app.api_impl as api
+import app.benchmark as benchmark
+from app.views import THIS_APP_VERSION
+
+class Command(BaseCommand):
+    help = 'Time the menu tree operations on a synthetic tree and write the results to a JSON file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--width', type=int, default=10, help='Children of each item. Defaults to 10.')
+        parser.add_argument('--depth', type=int, default=3,
+            help='Levels beneath the root menu, at most {0}. Defaults to 3.'.format(api.MAX_MENU_DEPTH - 1))
+        parser.add_argument('--skew', type=float, default=0.0,
+            help='0 for a balanced tree. Towards 1 the later siblings have fewer children.')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed calls of each operation. Defaults to 3.')
+        parser.add_argument('--replica', action='store_true', help='Serve the reads from the in-process tree replica.')
+        parser.add_argument('--label', default='', help='A note stored with the results, e.g. the release.')
+        parser.add_argument('--output', default='benchmark.json', help='The JSON results file. Defaults to benchmark.json.')
+
+    def handle(self, *args, **options):
+        if not 0.0 <= options['skew'] < 1.0:
+            raise CommandError('--skew must be at least 0 and less than 1.')
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1.')
+
+        oldname = connection.settings_dict['NAME']
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(TREE_REPLICA=options['replica']):
+                results = benchmark.run(width=options['width'], depth=options['depth'],
+                                        skew=options['skew'], repeat=options['repeat'])
+        except (ValueError, api.MenuTreeError) as e:
+            raise CommandError(str(e))
+        finally:
+            connection.creation.destroy_test_db(oldname, verbosity=0)
+            teardown_test_environment()
+
+        results.update({
+            'label': options['label'],
+            'created': timezone.now().isoformat(),
+            'version': '.'.join(str(x) for x in THIS_APP_VERSION),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'replica': options['replica'],
+            })
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+        self.stdout.write('{0} items, {1} levels, width {2}, skew {3}'.format(
+            results['tree']['nodes'], options['depth'], options['width'], options['skew']))
+        self.stdout.write('{0:<16} {1:>10} {2:>8} {3:>12}'.format('operation', 'median ms', 'queries', 'peak KiB'))
+        for name in sorted(results['results']):
+            result = results['results'][name]
+            peak = '{0:.1f}'.format(result['peak_bytes'] / 1024.0) if result['peak_bytes'] is not None else '-'
+            self.stdout.write('{0:<16} {1:>10.2f} {2:>8} {3:>12}'.format(
+                name, result['median'] * 1000, result['queries'], peak))
+        self.stdout.write('Results written to {0}'.format(options['output']))
@@ -0,0 +1,26 @@
+"""
+Trim old entries from the journal of changes to the menu tree.
+Clients that have not synchronised since the trimmed entries must then
+download the whole tree again.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from datetime import timedelta
+
+import app.journal as journal
+
+class Command(BaseCommand):
+    help = 'Remove the journal entries older than a number of days.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=30, help='Keep the changes of this many days. Defaults to 30.')
+
+    def handle(self, *args, **options):
+        if options['days'] < 0:
+            raise CommandError('--days cannot be negative.')
+        with transaction.atomic():
+            removed = journal.compact(timezone.now() - timedelta(days=options['days']))
+        self.stdout.write('Removed {0} journal entries.'.format(removed))
@@ -0,0 +1,35 @@
+"""
+Export a menu subtree as ndjson or as an indented outline.
+The rows are streamed from the database, so large trees are written
+without being held in memory.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+import io
+
+from app.models import Menu
+import app.transfer as transfer
+
+class Command(BaseCommand):
+    help = 'Write the subtree of a menu to a file, or to stdout, as ndjson or an indented outline.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--menu', type=int, default=1, help='The menu id at the root of the export. Defaults to 1.')
+        parser.add_argument('--format', choices=sorted(transfer.FORMATS), default='ndjson')
+        parser.add_argument('--depth', type=int, default=-1, help='Levels of descendants to export. Defaults to all.')
+        parser.add_argument('--no-root', action='store_true', help='Leave out the menu itself, exporting only its descendants.')
+        parser.add_argument('--output', default='-', help='The file to write. Defaults to stdout.')
+
+    def handle(self, *args, **options):
+        if not Menu.objects.filter(id=options['menu']).exists():
+            raise CommandError('There is no menu {0}.'.format(options['menu']))
+        lines = transfer.FORMATS[options['format']][0]
+        rows = transfer.export_rows(options['menu'], options['depth'])
+        if options['output'] == '-':
+            for line in lines(rows, include_root=not options['no_root']):
+                self.stdout.write(line, ending='')
+            return
+        with io.open(options['output'], 'w', encoding='utf-8') as output:
+            for line in lines(rows, include_root=not options['no_root']):
+                output.write(line)
@@ -0,0 +1,41 @@
+"""
+Import an ndjson or indented outline file beneath a menu.
+The file is read line by line and inserted in bulk_create batches inside
+one transaction, so nothing is added if any line is rejected.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+import io
+import sys
+
+from app.models import Menu
+import app.api_impl as api
+import app.transfer as transfer
+
+class Command(BaseCommand):
+    help = 'Add the menu items of an ndjson or indented outline file beneath a menu.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='The file to read, or - for stdin.')
+        parser.add_argument('--parent', type=int, default=1, help='The menu id to add the items beneath. Defaults to 1.')
+        parser.add_argument('--format', choices=sorted(transfer.FORMATS), default='ndjson')
+        parser.add_argument('--batch-size', type=int, default=transfer.IMPORT_BATCH_SIZE,
+            help='Menu items per bulk insert. Defaults to {0}.'.format(transfer.IMPORT_BATCH_SIZE))
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        items = transfer.FORMATS[options['format']][1]
+        try:
+            if options['file'] == '-':
+                source = io.open(sys.stdin.fileno(), 'r', encoding='utf-8', closefd=False)
+            else:
+                source = io.open(options['file'], 'r', encoding='utf-8')
+            with source:
+                count = transfer.import_tree(options['parent'], items(source), batch_size=options['batch_size'])
+        except (IOError, UnicodeDecodeError, api.MenuTreeError) as e:
+            raise CommandError(str(e))
+        except Menu.DoesNotExist:
+            raise CommandError('There is no menu {0}.'.format(options['parent']))
+        self.stdout.write('Imported {0} menu items beneath menu {1}.'.format(count, options['parent']))
@@ -0,0 +1,36 @@
+"""
+Issue or revoke the signed bearer tokens that authorise machine clients
+of the JSON API.
+"""
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+import app.tokens as tokens
+
+class Command(BaseCommand):
+    help = 'Print an API token for a user, or revoke all of the tokens of a user.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--perm', action='append', dest='perms',
+            help='A permission granted to the token, e.g. app.add_menu. Repeat for more. Defaults to all of the user\'s.')
+        parser.add_argument('--max-age', type=int, help='Seconds until the token expires. Defaults to API_TOKEN_MAX_AGE.')
+        parser.add_argument('--revoke', action='store_true', help='Revoke the tokens issued to the user so far instead.')
+
+    def handle(self, *args, **options):
+        try:
+            user = get_user_model().objects.get_by_natural_key(options['username'])
+        except get_user_model().DoesNotExist:
+            raise CommandError('There is no user {0}.'.format(options['username']))
+        if options['revoke']:
+            tokens.revoke(user.pk)
+            self.stdout.write('Revoked the tokens of {0}.'.format(user.get_username()))
+            return
+        if not user.is_active:
+            raise CommandError('{0} is not active.'.format(user.get_username()))
+        try:
+            token = tokens.issue(user, permissions=options['perms'], max_age=options['max_age'])
+        except tokens.TokenError as e:
+            raise CommandError(str(e))
+        self.stdout.write(token)
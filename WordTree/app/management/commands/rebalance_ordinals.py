@@ -0,0 +1,42 @@
+"""
+Respace sparse sibling ordinals that have run short of room.
+Intended to be run periodically, e.g. from cron, so that moves rarely
+need to rebalance their siblings while handling a request.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from app.models import Submenu
+import app.api_impl as api
+
+class Command(BaseCommand):
+    help = 'Respace the ordinals of menus whose children are closer together than --min-gap.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--parent', type=int, help='Only rebalance the children of this menu id.')
+        parser.add_argument('--min-gap', type=int, default=None,
+            help='Rebalance when two adjacent siblings are closer than this. Defaults to MENU_ORDINAL_GAP / 16.')
+
+    def handle(self, *args, **options):
+        gap = api.ordinal_gap()
+        if gap == 1:
+            self.stdout.write('MENU_ORDINAL_GAP is 1: ordinals are dense, nothing to do.')
+            return
+        mingap = options['min_gap'] or max(2, gap // 16)
+
+        if options['parent']:
+            parents = [options['parent']]
+        else:
+            parents = Submenu.objects.order_by('parent_id').values_list('parent_id', flat=True).distinct()
+
+        rebalanced = []
+        for parentid in parents:
+            ordinals = list(Submenu.objects.filter(parent=parentid).order_by('ordinal', 'child_id').values_list('ordinal', flat=True))
+            spacing = [b - a for a, b in zip([0] + ordinals, ordinals)]
+            if spacing and min(spacing) < mingap:
+                with transaction.atomic():
+                    api.rebalance_ordinals(parentid)
+                    api.tree_changed(parentid)
+                rebalanced.append(parentid)
+        self.stdout.write('Rebalanced the children of {0} menus.'.format(len(rebalanced)))
@@ -0,0 +1,23 @@
+"""
+Recompute the denormalized child_count and descendant_count of menu items
+from the Submenu records, e.g. after editing the tables by hand.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from app.models import Menu
+import app.api_impl as api
+
+class Command(BaseCommand):
+    help = 'Recompute the child and descendant counts of all menu items in one pass.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--menu', type=int, help='Only recount this menu id and its descendants.')
+
+    def handle(self, *args, **options):
+        if options['menu'] and not Menu.objects.filter(id=options['menu']).exists():
+            raise CommandError('There is no menu {0}.'.format(options['menu']))
+        with transaction.atomic():
+            updated = api.recount(options['menu'])
+        self.stdout.write('Recounted {0} menu items.'.format(updated))
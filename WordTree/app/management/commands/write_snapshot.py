@@ -0,0 +1,33 @@
+"""
+Write the binary snapshot of the menu tree that the workers memory-map.
+Run it after bulk changes, or periodically; until the next run, reads fall
+back to the database whenever the tree has changed since the snapshot.
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from app.models import Menu
+import app.api_impl as api
+import app.snapshot as snapshot
+
+class Command(BaseCommand):
+    help = 'Write the menu tree to the memory-mapped snapshot file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='The snapshot file. Defaults to settings.TREE_SNAPSHOT.')
+
+    def handle(self, *args, **options):
+        path = options['output'] or getattr(settings, 'TREE_SNAPSHOT', None)
+        if not path:
+            raise CommandError('Give --output or set TREE_SNAPSHOT.')
+        with transaction.atomic():
+            try:
+                # Read the version first: a change made while the rows are
+                # read leaves the snapshot out of date rather than mislabelled.
+                version = snapshot.root_version()
+            except Menu.DoesNotExist:
+                raise CommandError('There is no root menu.')
+            count = snapshot.write(path, api.iter_subtree(snapshot.ROOT_ID), version)
+        self.stdout.write('Wrote {0} menu items at version {1} to {2}.'.format(count, version, path))
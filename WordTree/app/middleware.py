@@ -0,0 +1,112 @@
+"""
+Definition of middleware.
+"""
+from django.conf import settings
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class QueryCounter(object):
+    """
+    The number of queries run through the cursors of counting() and the
+    seconds spent in them.
+    """
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def counting(self, make_cursor):
+        """
+        Wraps a connection's make_cursor method so that its cursors count here.
+        """
+        def make_counting_cursor(cursor):
+            return CountingCursorWrapper(make_cursor(cursor), self)
+        return make_counting_cursor
+
+class CountingCursorWrapper(CursorWrapper):
+    """
+    A cursor that adds each query it runs, and the time it took, to a QueryCounter.
+    """
+    def __init__(self, cursor, counter):
+        super(CountingCursorWrapper, self).__init__(cursor, cursor.db)
+        self.counter = counter
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return super(CountingCursorWrapper, self).execute(sql, params)
+        finally:
+            self.counter.queries += 1
+            self.counter.seconds += time.time() - start
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return super(CountingCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            self.counter.queries += 1
+            self.counter.seconds += time.time() - start
+
+class QueryBudgetMiddleware(object):
+    """
+    Counts the SQL queries, the time spent in the database and the time
+    spent in the view for each request.
+
+    With DEBUG enabled the totals are returned in the X-DB-Queries, X-DB-Time
+    and X-View-Time response headers (times in milliseconds).
+    A warning is logged when a view runs more queries than its budget:
+    QUERY_BUDGETS maps view names (e.g. 'app.views.menu') to their budgets
+    and QUERY_BUDGET is the budget of every other view (None for no limit).
+
+    Queries made while a streaming response is being sent are not counted.
+    They are counted by wrapping each connection's cursors for the request,
+    so the count does not depend on connection.queries, which is bounded.
+    Without DEBUG or any budget nothing is recorded.
+    """
+    def process_request(self, request):
+        if not (settings.DEBUG or getattr(settings, 'QUERY_BUDGETS', None) or
+                getattr(settings, 'QUERY_BUDGET', None) is not None):
+            return
+        counter = QueryCounter()
+        request.query_budget = {
+            'start': time.time(),
+            'view': None,
+            'counter': counter,
+            'connections': connections.all(),
+            }
+        for connection in request.query_budget['connections']:
+            # connection.cursor() makes its cursors with one or the other.
+            connection.make_cursor = counter.counting(connection.make_cursor)
+            connection.make_debug_cursor = counter.counting(connection.make_debug_cursor)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, 'query_budget'):
+            request.query_budget['view'] = '{0}.{1}'.format(view_func.__module__, view_func.__name__)
+
+    def process_response(self, request, response):
+        budget = getattr(request, 'query_budget', None)
+        if budget is None:
+            return response
+        for connection in budget['connections']:
+            # Back to the methods of the connection's class.
+            del connection.make_cursor
+            del connection.make_debug_cursor
+        queries = budget['counter'].queries
+        seconds = budget['counter'].seconds
+        elapsed = time.time() - budget['start']
+
+        if settings.DEBUG:
+            response['X-DB-Queries'] = str(queries)
+            response['X-DB-Time'] = '{0:.1f}'.format(seconds * 1000)
+            response['X-View-Time'] = '{0:.1f}'.format(elapsed * 1000)
+
+        view = budget['view']
+        limit = getattr(settings, 'QUERY_BUDGETS', {}).get(view, getattr(settings, 'QUERY_BUDGET', None))
+        if limit is not None and queries > limit:
+            logger.warning("{0} ran {1} queries, over its budget of {2}: '{3}'".format(
+                view, queries, limit, request.get_full_path()))
+        return response
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def backfill_paths(apps, schema_editor):
+    """
+    Compute the materialized path and depth of every existing Submenu row.
+    Menu items without a Submenu row (i.e. the root) start each path.
+    """
+    Submenu = apps.get_model('app', 'Submenu')
+    parents = dict(Submenu.objects.values_list('child_id', 'parent_id'))
+    children = {}
+    for childid, parentid in parents.items():
+        children.setdefault(parentid, []).append(childid)
+
+    pending = [(rootid, '/{0}/'.format(rootid), 0)
+               for rootid in children if rootid not in parents]
+    while pending:
+        parentid, parentpath, parentdepth = pending.pop()
+        for childid in children.get(parentid, []):
+            path = '{0}{1}/'.format(parentpath, childid)
+            Submenu.objects.filter(child_id=childid).update(path=path, depth=parentdepth + 1)
+            pending.append((childid, path, parentdepth + 1))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_auto_20160613_1051'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submenu',
+            name='path',
+            field=models.CharField(db_index=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='submenu',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_submenu_path_depth'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='submenu',
+            name='ordinal',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 02:45
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_menu_version'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='submenu',
+            index_together=set([('parent', 'ordinal', 'child')]),
+        ),
+    ]
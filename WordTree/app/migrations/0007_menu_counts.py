@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# Count the children and the descendants of every menu item in one statement.
+# The descendants of an item are the range of paths that start with its path.
+RECOUNT_SQL = """
+UPDATE app_menu SET
+    child_count = (SELECT COUNT(*) FROM app_submenu s WHERE s.parent_id = app_menu.id),
+    descendant_count = (
+        SELECT COUNT(*) FROM app_submenu s, (
+            SELECT COALESCE(
+                (SELECT o.path FROM app_submenu o WHERE o.child_id = app_menu.id),
+                '/' || app_menu.id || '/') AS path
+        ) own
+        WHERE s.path > own.path AND s.path < substr(own.path, 1, length(own.path) - 1) || '0')
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_submenu_children_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='menu',
+            name='child_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='menu',
+            name='descendant_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunSQL([RECOUNT_SQL], migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.utils import OperationalError
+
+
+# An external content FTS5 index of app_menu, kept in step by triggers.
+# The triggers only fire for changes to name or data, so the frequent
+# version bumps do not touch the index.
+CREATE_SQL = [
+    """CREATE VIRTUAL TABLE app_menu_fts USING fts5(
+        name, data, content='app_menu', content_rowid='id', prefix='2 3')""",
+    """CREATE TRIGGER app_menu_fts_insert AFTER INSERT ON app_menu BEGIN
+        INSERT INTO app_menu_fts(rowid, name, data) VALUES (new.id, new.name, new.data);
+    END""",
+    """CREATE TRIGGER app_menu_fts_delete AFTER DELETE ON app_menu BEGIN
+        INSERT INTO app_menu_fts(app_menu_fts, rowid, name, data) VALUES ('delete', old.id, old.name, old.data);
+    END""",
+    """CREATE TRIGGER app_menu_fts_update AFTER UPDATE OF name, data ON app_menu BEGIN
+        INSERT INTO app_menu_fts(app_menu_fts, rowid, name, data) VALUES ('delete', old.id, old.name, old.data);
+        INSERT INTO app_menu_fts(rowid, name, data) VALUES (new.id, new.name, new.data);
+    END""",
+    "INSERT INTO app_menu_fts(app_menu_fts) VALUES ('rebuild')",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS app_menu_fts_insert",
+    "DROP TRIGGER IF EXISTS app_menu_fts_delete",
+    "DROP TRIGGER IF EXISTS app_menu_fts_update",
+    "DROP TABLE IF EXISTS app_menu_fts",
+]
+
+
+def create_index(apps, schema_editor):
+    """
+    Only SQLite has FTS5; elsewhere app.search falls back to icontains.
+    SQLite builds without FTS5 fall back the same way.
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(CREATE_SQL[0])
+    except OperationalError:
+        # no such module: fts5
+        return
+    for sql in CREATE_SQL[1:]:
+        schema_editor.execute(sql)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for sql in DROP_SQL:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_menu_counts'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
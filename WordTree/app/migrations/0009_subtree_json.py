@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 03:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_menu_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubtreeJson',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.SmallIntegerField()),
+                ('version', models.PositiveIntegerField()),
+                ('json', models.TextField()),
+                ('menu', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='json_fragments', to='app.Menu')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='subtreejson',
+            unique_together=set([('menu', 'depth')]),
+        ),
+    ]
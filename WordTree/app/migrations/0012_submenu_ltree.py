@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, transaction
+from django.db.utils import DatabaseError
+
+
+# An ltree copy of app_submenu.path, e.g. '1.5.42' for '/1/5/42/', kept in
+# step by a trigger and indexed with GiST for the <@ and @> operators.
+# The column is not part of the model; app.api_impl queries it directly.
+CREATE_SQL = [
+    "CREATE EXTENSION IF NOT EXISTS ltree",
+    "ALTER TABLE app_submenu ADD COLUMN lpath ltree",
+    """CREATE FUNCTION app_submenu_lpath() RETURNS trigger AS $$
+    BEGIN
+        NEW.lpath := text2ltree(replace(trim(both '/' from NEW.path), '/', '.'));
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql""",
+    """CREATE TRIGGER app_submenu_lpath BEFORE INSERT OR UPDATE OF path ON app_submenu
+        FOR EACH ROW EXECUTE PROCEDURE app_submenu_lpath()""",
+    "UPDATE app_submenu SET lpath = text2ltree(replace(trim(both '/' from path), '/', '.'))",
+    "CREATE INDEX app_submenu_lpath_gist ON app_submenu USING GIST (lpath)",
+    # The counts of migration 0007 relied on '/' sorting before '0',
+    # which depends on the database's collation here; count them again.
+    """UPDATE app_menu SET
+        descendant_count = (
+            SELECT COUNT(*) FROM app_submenu s
+            WHERE s.lpath <@ COALESCE(
+                    (SELECT o.lpath FROM app_submenu o WHERE o.child_id = app_menu.id),
+                    text2ltree(app_menu.id::text))
+                AND s.child_id <> app_menu.id)""",
+]
+
+DROP_SQL = [
+    "DROP TRIGGER IF EXISTS app_submenu_lpath ON app_submenu",
+    "DROP FUNCTION IF EXISTS app_submenu_lpath()",
+    "DROP INDEX IF EXISTS app_submenu_lpath_gist",
+    "ALTER TABLE app_submenu DROP COLUMN IF EXISTS lpath",
+]
+
+
+def create_lpath(apps, schema_editor):
+    """
+    Only PostgreSQL has ltree; elsewhere the path range scans are used.
+    Servers without the ltree extension fall back the same way.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    try:
+        with transaction.atomic():
+            with schema_editor.connection.cursor() as cursor:
+                cursor.execute(CREATE_SQL[0])
+    except DatabaseError:
+        # extension "ltree" is not available, or may not be created
+        return
+    for sql in CREATE_SQL[1:]:
+        schema_editor.execute(sql)
+
+
+def drop_lpath(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for sql in DROP_SQL:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_token_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_lpath, drop_lpath),
+    ]
@@ -2,7 +2,9 @@
 Definition of models.
 """
 
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
 
@@ -10,6 +12,12 @@ class Menu(models.Model):
     #id = models.AutoField() # Implicitly added for all modelled objects
     name = models.CharField(max_length=50)
     data = models.TextField(blank=True)
+    # Bumped whenever this item or any of its descendants changes.
+    version = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(default=timezone.now)
+    # Kept up to date by every write to the tree; see api_impl.add_counts.
+    child_count = models.PositiveIntegerField(default=0)
+    descendant_count = models.PositiveIntegerField(default=0)
 
     def __unicode__(self):
         return u'{ "id": %d, "name": "%s"" }' % (self.id, self.name)
@@ -18,8 +26,55 @@ class Submenu(models.Model):
     child = models.OneToOneField(Menu, related_name='children')
     child.primary_key = True
     parent = models.ForeignKey(Menu)
-    ordinal = models.PositiveSmallIntegerField(default=0)
+    ordinal = models.PositiveIntegerField(default=0)
+    # Materialized path of ids from the root down to child, e.g. /1/5/42/
+    path = models.CharField(max_length=255, db_index=True, default='')
+    # Number of levels below the root, i.e. children of the root have depth 1.
+    depth = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        # Keyset pagination of a menu's children in display order.
+        index_together = [['parent', 'ordinal', 'child']]
 
     def __unicode__(self):
         return u'{ "parent_id": %d, "child_id": %d, "ordinal": %d }' % (self.parent.id, self.child.id, self.ordinal)
 
+
+class SubtreeJson(models.Model):
+    """
+    The serialized submenu list of a menu item, to depth levels (-1 == all).
+    Valid while version equals the item's version; see app.jsoncache.
+    """
+    menu = models.ForeignKey(Menu, related_name='json_fragments')
+    depth = models.SmallIntegerField()
+    version = models.PositiveIntegerField()
+    json = models.TextField()
+
+    class Meta:
+        unique_together = [['menu', 'depth']]
+
+    def __unicode__(self):
+        return u'{ "menu_id": %d, "depth": %d, "version": %d }' % (self.menu_id, self.depth, self.version)
+
+class Change(models.Model):
+    """
+    One entry of the append-only journal of changes to the tree; the id is
+    its sequence number. data is the JSON of the delta; see app.journal.
+    """
+    action = models.CharField(max_length=10)
+    data = models.TextField()
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __unicode__(self):
+        return u'{ "seq": %d, "action": "%s" }' % (self.id, self.action)
+
+class TokenKey(models.Model):
+    """
+    The key version of a user's API tokens. Bumping it revokes every token
+    issued to the user before; see app.tokens.
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, primary_key=True, related_name='token_key')
+    version = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return u'{ "user_id": %d, "version": %d }' % (self.user_id, self.version)
@@ -0,0 +1,176 @@
+"""
+In-process replica of the menu tree.
+
+Each worker process lazily loads the whole Menu/Submenu tree into an
+immutable TreeSnapshot and serves reads from it until the tree changes.
+Writers call invalidate(), which bumps a generation counter held in the
+default cache. Readers compare the counter with the generation of their
+snapshot and reload when it has moved on.
+
+The subtree and children reads of app.api_impl, and with them api.menu_get
+and its ETag and Last-Modified validators, are then served without a
+database query; only the generation is read from the cache. The HTML views
+still read the chosen item and its path from the database.
+
+The replica is disabled unless settings.TREE_REPLICA is True.
+When several worker processes are used the default cache must be shared
+between them (e.g. memcached) so they all see the same generation.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+from collections import namedtuple
+import logging
+import threading
+import time
+
+import app.traversal as traversal
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'app.replica.generation'
+
+# The root of the tree has parentid None and ordinal 0.
+Node = namedtuple('Node', ['id', 'parentid', 'ordinal', 'name', 'data', 'child_count', 'descendant_count',
+                           'version', 'modified'])
+
+# Every menu item with its Submenu record, siblings in display order.
+SNAPSHOT_SQL = """
+SELECT m.id, s.parent_id, COALESCE(s.ordinal, 0), m.name, m.data, m.child_count, m.descendant_count,
+    m.version, m.modified
+FROM app_menu m LEFT JOIN app_submenu s ON s.child_id = m.id
+ORDER BY s.parent_id, s.ordinal, m.id
+"""
+
+class TreeSnapshot(object):
+    """
+    An immutable copy of the whole tree as at generation.
+    """
+    def __init__(self, generation, rows):
+        self.generation = generation
+        nodes = {}
+        children = {}
+        for row in rows:
+            node = Node(*row[:-1], modified=aware(row[-1]))
+            nodes[node.id] = node
+            children.setdefault(node.parentid, []).append(node.id)
+        self.nodes = nodes
+        self.children = dict((id, tuple(ids)) for id, ids in children.items())
+
+    def children_ids(self, parentid):
+        """
+        Returns the ids of the direct children of parentid.
+        """
+        return self.children.get(parentid, ())
+
+    def children_of(self, parentid):
+        """
+        Returns the Node tuples of the direct children of parentid.
+        """
+        return [self.nodes[id] for id in self.children_ids(parentid)]
+
+    def children_page(self, parentid, after=None, limit=100):
+        """
+        Returns up to limit Node tuples of the children of parentid that follow
+        the (ordinal, id) pair after, and whether any more children follow them.
+        """
+        ids = self.children_ids(parentid)
+        start = 0
+        if after is not None:
+            # Binary search, as the children are held in (ordinal, id) order.
+            high = len(ids)
+            while start < high:
+                middle = (start + high) // 2
+                node = self.nodes[ids[middle]]
+                if (node.ordinal, node.id) <= tuple(after):
+                    start = middle + 1
+                else:
+                    high = middle
+        return [self.nodes[id] for id in ids[start:start + limit]], start + limit < len(ids)
+
+    def subtree_rows(self, id, depth=-1):
+        """
+        Returns the subtree rooted at id as (id, parentid, ordinal, level, name, data)
+        rows in level order, i.e. the same shape as api_impl.SUBTREE_SQL.
+        Returns an empty list if the menu item id does not exist.
+        """
+        if id not in self.nodes:
+            return []
+        rows = []
+        for nodeid, parentid, level in traversal.walk(id, self.children_ids, order=traversal.LEVELORDER, depth=depth):
+            node = self.nodes[nodeid]
+            rows.append((node.id, node.parentid, node.ordinal, level, node.name, node.data))
+        return rows
+
+    def subtree_preorder(self, id, depth=-1):
+        """
+        Yields the subtree rooted at id as (id, ordinal, level, name) rows
+        in pre-order, i.e. the same shape as api_impl.PREORDER_SQL.
+        Yields nothing if the menu item id does not exist.
+        """
+        if id not in self.nodes:
+            return
+        for nodeid, parentid, level in traversal.walk(id, self.children_ids, depth=depth):
+            node = self.nodes[nodeid]
+            yield node.id, node.ordinal, level, node.name
+
+def aware(value):
+    """
+    SQLite's cursors return naive datetimes, which are in UTC when USE_TZ is on.
+    """
+    if settings.USE_TZ and value is not None and timezone.is_naive(value):
+        return timezone.make_aware(value, timezone.utc)
+    return value
+
+_lock = threading.Lock()
+_snapshot = None
+
+def enabled():
+    return getattr(settings, 'TREE_REPLICA', False)
+
+def generation():
+    """
+    Returns the current tree generation from the cache.
+    If the counter is missing (e.g. evicted) restart it from the clock
+    so that it cannot match the generation of an older snapshot.
+    """
+    value = cache.get(GENERATION_KEY)
+    if value is None:
+        cache.add(GENERATION_KEY, int(time.time() * 1000), None)
+        value = cache.get(GENERATION_KEY)
+    return value
+
+def invalidate():
+    """
+    Record that the tree has changed, so every worker reloads its snapshot.
+    Inside a transaction this waits until it commits: until then another
+    worker would load the old tree under the new generation and keep it.
+    """
+    transaction.on_commit(bump_generation)
+
+def bump_generation():
+    global _snapshot
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # Not yet set, or evicted.
+        generation()
+    with _lock:
+        _snapshot = None
+
+def current():
+    """
+    Returns the TreeSnapshot for the current generation, loading it if necessary.
+    """
+    global _snapshot
+    latest = generation()
+    with _lock:
+        if _snapshot is None or _snapshot.generation != latest:
+            logger.info("replica.current() loading generation {0}".format(latest))
+            with connection.cursor() as cursor:
+                cursor.execute(SNAPSHOT_SQL)
+                _snapshot = TreeSnapshot(latest, cursor.fetchall())
+        return _snapshot
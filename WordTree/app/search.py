@@ -0,0 +1,99 @@
+"""
+Search of menu item names and data.
+
+On SQLite the app_menu_fts FTS5 index (see migration 0008) answers
+searches without scanning app_menu, ranking hits by bm25 with matches in
+the name weighted above matches in the data. Other databases, and SQLite
+builds without FTS5, fall back to an unranked icontains filter.
+"""
+
+from django.db import connection
+from django.db.models import Q
+
+from collections import namedtuple
+import re
+
+from app.models import Menu
+import app.api_impl as api
+
+FTS_TABLE = 'app_menu_fts'
+
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+
+# rank is None when the fallback search is used.
+SearchHit = namedtuple('SearchHit', ['id', 'name', 'path', 'rank', 'ancestors'])
+
+# Hits ordered by relevance, the name counting ten times as much as the data.
+SEARCH_SQL = """
+SELECT m.id, m.name, COALESCE(s.path, '/' || m.id || '/'), bm25(app_menu_fts, 10.0, 1.0) AS rank
+FROM app_menu_fts
+JOIN app_menu m ON m.id = app_menu_fts.rowid
+LEFT JOIN app_submenu s ON s.child_id = m.id
+WHERE app_menu_fts MATCH %s
+ORDER BY rank, m.id
+LIMIT %s OFFSET %s
+"""
+
+# Whether the FTS5 index exists, by database name.
+_available = {}
+
+def available():
+    """
+    Whether the FTS5 index exists in the current database, looked up once
+    per database in each process.
+    """
+    if connection.vendor != 'sqlite':
+        return False
+    name = connection.settings_dict['NAME']
+    if name not in _available:
+        _available[name] = FTS_TABLE in connection.introspection.table_names()
+    return _available[name]
+
+def fts_query(text):
+    """
+    An FTS5 query matching items that contain every word of text,
+    each as a word prefix. Quoting the words keeps the FTS5 query syntax
+    out of the user's hands. Returns None if text has no words.
+    """
+    words = re.findall(r'\w+', text, re.UNICODE)
+    if not words:
+        return None
+    return ' '.join('"{0}"*'.format(word) for word in words)
+
+def search(text, page=1, limit=SEARCH_PAGE_SIZE):
+    """
+    Returns up to limit SearchHit tuples for the given page of results
+    of searching for text, and the number of the next page or None.
+    Each hit carries its materialized path and its ancestors as MenuItem
+    objects, root first, looked up with one query for the whole page.
+    """
+    offset = (page - 1) * limit
+    if available():
+        query = fts_query(text)
+        if query is None:
+            return [], None
+        with connection.cursor() as cursor:
+            cursor.execute(SEARCH_SQL, [query, limit + 1, offset])
+            rows = cursor.fetchall()
+    else:
+        words = re.findall(r'\w+', text, re.UNICODE)
+        if not words:
+            return [], None
+        menus = Menu.objects.all()
+        for word in words:
+            menus = menus.filter(Q(name__icontains=word) | Q(data__icontains=word))
+        rows = [(id, name, path or '/{0}/'.format(id), None) for id, name, path in
+                menus.order_by('id').values_list('id', 'name', 'children__path')[offset:offset + limit + 1]]
+
+    next = page + 1 if len(rows) > limit else None
+    rows = rows[:limit]
+    ancestorids = set()
+    for id, name, path, rank in rows:
+        ancestorids.update(api.path_ids(path)[:-1])
+    names = dict(Menu.objects.filter(id__in=ancestorids).values_list('id', 'name'))
+    hits = [SearchHit(id=id, name=name, path=path, rank=rank,
+                      ancestors=[api.MenuItem(id=ancestor, name=names.get(ancestor, ''), data='')
+                                 for ancestor in api.path_ids(path)[:-1]])
+            for id, name, path, rank in rows]
+    return hits, next
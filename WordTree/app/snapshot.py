@@ -0,0 +1,241 @@
+"""
+Memory-mapped binary snapshot of the menu tree.
+
+The write_snapshot command dumps the tree beneath the root menu to a file
+holding the arrays of a CompactTree with fixed-width items, followed by the
+names as one UTF-8 string pool:
+
+    header     MAGIC, byte order, root version, node count, pool size
+    ids        int64[count]   menu item ids in pre-order
+    offsets    int64[count+1] offsets of the names in the pool
+    byid       int32[count]   node indexes sorted by id, for find()
+    ordinals   int32[count]
+    parents    int32[count]
+    ends       int32[count]
+    levels     int16[count]
+    pool       the names, end to end
+
+Every worker maps the file read-only, so they all share its pages and
+nothing is parsed when it is loaded; the arrays are memoryviews of the map.
+
+The file is replaced atomically (written beside it, then renamed), and
+readers notice a new file by its inode, size and modification time,
+mapping it in place of the old one without a restart. A snapshot is only
+used while the version of the root menu, which every change to the tree
+bumps, is the version it was written at; otherwise the reads fall back
+to the replica or the database.
+
+Reads do not query the database for that version. It is read again only
+when the tree generation of app.replica, which every write bumps once it
+commits, has moved on or another file has been mapped, and the file is
+looked at again once the last look is more than TREE_SNAPSHOT_CHECK_INTERVAL
+seconds old. So, as for the replica, several workers need a shared cache.
+
+Snapshots are disabled unless settings.TREE_SNAPSHOT names the file.
+"""
+
+from django.conf import settings
+
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+
+from app.compact import CompactTree, StringTable
+from app.models import Menu
+import app.replica as replica
+
+logger = logging.getLogger(__name__)
+
+ROOT_ID = 1
+
+MAGIC = b'WTSNAP01'
+
+# magic, byte order ('l' or 'b'), padding, root version, count, pool size
+HEADER = struct.Struct('<8sc7xqqq')
+
+# (name, typecode, items beyond count) of each array, in file order.
+# The widest come first so every array is aligned to its item size.
+ARRAYS = (
+    ('ids', 'q', 0),
+    ('offsets', 'q', 1),
+    ('byid', 'i', 0),
+    ('ordinals', 'i', 0),
+    ('parents', 'i', 0),
+    ('ends', 'i', 0),
+    ('levels', 'h', 0),
+    )
+
+BYTE_ORDER = b'l' if sys.byteorder == 'little' else b'b'
+
+class SnapshotError(Exception):
+    """
+    The snapshot file is not one this build can read.
+    """
+
+def enabled():
+    return bool(getattr(settings, 'TREE_SNAPSHOT', None))
+
+def root_version():
+    return Menu.objects.values_list('version', flat=True).get(id=ROOT_ID)
+
+def write(path, rows, version):
+    """
+    Writes the pre-order (id, ordinal, level, name) rows of the tree, read at
+    root version version, to a snapshot file at path.
+    The file is written beside path and renamed over it, so readers always
+    see either the old snapshot or the whole new one.
+    Returns the number of items written.
+    """
+    tree = CompactTree.from_rows(rows)
+    count = len(tree) if tree is not None else 0
+    offsets = array('q', [0])
+    pool = bytearray()
+    for index in range(count):
+        pool += tree.names[index].encode('utf-8')
+        offsets.append(len(pool))
+    arrays = {
+        'offsets': offsets,
+        'byid': array('i', sorted(range(count), key=tree.ids.__getitem__)),
+        }
+    for name, typecode, extra in ARRAYS:
+        if name not in arrays:
+            arrays[name] = array(typecode, getattr(tree, name) if tree is not None else [])
+
+    temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(temporary, 'wb') as output:
+            output.write(HEADER.pack(MAGIC, BYTE_ORDER, version, count, len(pool)))
+            for name, typecode, extra in ARRAYS:
+                arrays[name].tofile(output)
+            output.write(pool)
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    logger.info("snapshot.write({0}) wrote {1} items at version {2}".format(path, count, version))
+    return count
+
+class MappedTree(object):
+    """
+    A snapshot file mapped read-only into memory.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as input:
+            stat = os.fstat(input.fileno())
+            self.key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            # The map stays valid after the file is closed or replaced.
+            self.map = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            raise SnapshotError('{0} is too short to be a snapshot.'.format(path))
+        magic, order, self.version, count, poolsize = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise SnapshotError('{0} is not a snapshot.'.format(path))
+        if order != BYTE_ORDER:
+            raise SnapshotError('{0} was written with the other byte order.'.format(path))
+        view = memoryview(self.map)
+        offset = HEADER.size
+        arrays = {}
+        for name, typecode, extra in ARRAYS:
+            size = (count + extra) * array(typecode).itemsize
+            arrays[name] = view[offset:offset + size].cast(typecode)
+            offset += size
+        if offset + poolsize != len(self.map):
+            raise SnapshotError('{0} is truncated.'.format(path))
+        self.byid = arrays['byid']
+        names = StringTable(view[offset:offset + poolsize], arrays['offsets'], encoding='utf-8')
+        self.tree = CompactTree(arrays['ids'], arrays['ordinals'], arrays['levels'],
+                                arrays['parents'], arrays['ends'], names) if count else None
+
+    def find(self, id):
+        """
+        Returns the node index of the menu item id, or None.
+        """
+        ids = self.tree.ids if self.tree is not None else ()
+        low, high = 0, len(self.byid)
+        while low < high:
+            middle = (low + high) // 2
+            if ids[self.byid[middle]] < id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.byid) and ids[self.byid[low]] == id:
+            return self.byid[low]
+        return None
+
+    def subtree(self, id, depth=-1):
+        """
+        Returns a CompactTree of the subtree rooted at id, or None if the
+        menu item id is not in the snapshot. The whole tree is returned as
+        it is; a subtree is copied out of it.
+        """
+        index = self.find(id)
+        if index is None:
+            return None
+        if index == 0 and depth < 0:
+            return self.tree
+        return CompactTree.from_rows(self.tree.rows(index, depth))
+
+_lock = threading.Lock()
+_mapped = None
+
+def load(path):
+    """
+    Returns the MappedTree of the snapshot at path, remapping it if the file
+    has been replaced since it was last mapped. Returns None if there is no
+    file or it cannot be read.
+    """
+    global _mapped
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    with _lock:
+        if _mapped is None or _mapped.key != key:
+            try:
+                # The old map is released once no reader is using it.
+                _mapped = MappedTree(path)
+                logger.info("snapshot.load({0}) mapped version {1}".format(path, _mapped.version))
+            except (OSError, ValueError, SnapshotError) as e:
+                logger.warning("snapshot.load({0}) failed: {1}".format(path, e))
+                _mapped = None
+        return _mapped
+
+# (mapped, generation, whether it is current, time of the check) of the last
+# check of current(), or None.
+_checked = None
+
+def current():
+    """
+    Returns the MappedTree of settings.TREE_SNAPSHOT if it is up to date
+    with the tree, otherwise None.
+    """
+    global _checked
+    if not enabled():
+        return None
+    generation = replica.generation()
+    now = time.time()
+    checked = _checked
+    if checked is not None and checked[1] == generation \
+            and now - checked[3] < getattr(settings, 'TREE_SNAPSHOT_CHECK_INTERVAL', 1):
+        return checked[0] if checked[2] else None
+    mapped = load(settings.TREE_SNAPSHOT)
+    if mapped is None:
+        uptodate = False
+    elif checked is not None and checked[0] is mapped and checked[1] == generation:
+        uptodate = checked[2]
+    else:
+        try:
+            uptodate = mapped.version == root_version()
+        except Menu.DoesNotExist:
+            uptodate = False
+    _checked = (mapped, generation, uptodate, now)
+    return mapped if uptodate else None
@@ -0,0 +1,52 @@
+"""
+Template tags for rendering menu trees.
+"""
+from django import template
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+import app.traversal as traversal
+
+register = template.Library()
+
+# The whitespace around each nested include of app/menu_item.html,
+# kept so that the markup is unchanged.
+BRANCH_OPEN = '\n    '
+BRANCH_CLOSE = '\n'
+SUBMENU_OPEN = '\n    \n        '
+SUBMENU_CLOSE = '\n    \n'
+# The markup of app/menu_item.html itself.
+ITEM_OPEN = '\n<ul class="list-nobullet">\n<li><h4>'
+ITEM_CLOSE = '</li></ul>'
+
+@register.simple_tag
+def menu_tree(tree):
+    """
+    Renders the branches of tree as nested <ul>/<li> lists.
+    Produces the same markup as including app/menu_item.html for each branch,
+    but walks the tree iteratively and joins the pieces once at the end.
+    tree may be an api_impl.Tree or a compact.CompactNode.
+    """
+    if tree is None:
+        return ''
+    pieces = []
+
+    def enter(node, parent, level):
+        if level == 0:
+            return
+        pieces.append(BRANCH_OPEN if level == 1 else SUBMENU_OPEN)
+        pieces.append(ITEM_OPEN)
+        pieces.append(conditional_escape(node.id))
+        pieces.append(' ')
+        pieces.append(conditional_escape(node.name))
+        pieces.append('</h4>\n')
+
+    def leave(node, parent, level):
+        if level == 0:
+            return
+        pieces.append(ITEM_CLOSE)
+        pieces.append(BRANCH_CLOSE if level == 1 else SUBMENU_CLOSE)
+
+    for _ in traversal.walk(tree, lambda node: node.branches, enter=enter, leave=leave):
+        pass
+    return mark_safe(''.join(pieces))
@@ -0,0 +1,174 @@
+"""
+Signed bearer tokens for the JSON API.
+
+A token is the user id, the permissions granted to the token, its expiry
+time and two key versions, signed with SECRET_KEY by django.core.signing.
+A request carrying "Authorization: Bearer <token>" is authorised from the
+token alone, without loading a session, the user or their permissions.
+
+Tokens are revoked through the key versions:
+
+    settings.API_TOKEN_KEY_VERSION  bump it to revoke every token
+    TokenKey.version                bump it (revoke()) to revoke a user's tokens
+
+A user's key version is read from the database at most once every
+API_TOKEN_CHECK_INTERVAL seconds per worker process, so revoking a user's
+tokens takes effect within that time.
+
+Requests without a token go through the session login and permission
+checks as before, including the CSRF check. Tokens are not sent by the
+browser on its own, so requests that carry one need no CSRF check.
+"""
+
+from django.conf import settings
+from django.contrib.auth.decorators import login_required, permission_required
+from django.core import signing
+from django.db.models import F
+from django.http import JsonResponse
+from django.middleware.csrf import CsrfViewMiddleware
+
+from functools import wraps
+import logging
+import threading
+import time
+
+from app.models import TokenKey
+
+logger = logging.getLogger(__name__)
+
+TOKEN_SALT = 'app.tokens'
+
+class TokenError(Exception):
+    """
+    The token is malformed, has been tampered with, has expired or has been revoked.
+    """
+
+class TokenUser(object):
+    """
+    The user of a request authorised by a token, with only the permissions
+    granted to the token.
+    """
+    is_active = True
+    is_staff = False
+    is_superuser = False
+
+    def __init__(self, id, permissions):
+        self.id = self.pk = id
+        self.permissions = frozenset(permissions)
+
+    def is_authenticated(self):
+        return True
+
+    def is_anonymous(self):
+        return False
+
+    def has_perm(self, perm, obj=None):
+        return perm in self.permissions
+
+    def has_perms(self, perm_list, obj=None):
+        return all(perm in self.permissions for perm in perm_list)
+
+def global_version():
+    return getattr(settings, 'API_TOKEN_KEY_VERSION', 1)
+
+_lock = threading.Lock()
+# user id: (key version, time read)
+_versions = {}
+
+def key_version(userid, fresh=False):
+    """
+    The key version of the user's tokens, read again from the database
+    once it is more than API_TOKEN_CHECK_INTERVAL seconds old, or if fresh.
+    """
+    now = time.time()
+    with _lock:
+        cached = _versions.get(userid)
+    if not fresh and cached is not None and now - cached[1] < getattr(settings, 'API_TOKEN_CHECK_INTERVAL', 60):
+        return cached[0]
+    version = TokenKey.objects.filter(user_id=userid).values_list('version', flat=True).first() or 0
+    with _lock:
+        _versions[userid] = (version, now)
+    return version
+
+def issue(user, permissions=None, max_age=None):
+    """
+    Returns a token for user that expires after max_age seconds (by default
+    API_TOKEN_MAX_AGE) and grants the permissions, by default all of the
+    user's permissions.
+    Raises TokenError if the user does not hold all of the permissions.
+    """
+    held = user.get_all_permissions()
+    permissions = held if permissions is None else set(permissions)
+    if not permissions <= held:
+        raise TokenError('{0} does not have the permissions {1}.'.format(
+            user.get_username(), ', '.join(sorted(permissions - held))))
+    if max_age is None:
+        max_age = getattr(settings, 'API_TOKEN_MAX_AGE', 86400)
+    return signing.dumps({
+        'u': user.pk,
+        'p': sorted(permissions),
+        'x': int(time.time() + max_age),
+        'k': [global_version(), key_version(user.pk, fresh=True)],
+        }, salt=TOKEN_SALT, compress=True)
+
+def verify(token):
+    """
+    Returns the TokenUser of a valid token. Raises TokenError otherwise.
+    """
+    try:
+        payload = signing.loads(token, salt=TOKEN_SALT)
+        userid, permissions, expires, (globalversion, userversion) = payload['u'], payload['p'], payload['x'], payload['k']
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        raise TokenError('Invalid token.')
+    if time.time() > expires:
+        raise TokenError('The token has expired.')
+    if globalversion != global_version() or userversion != key_version(userid):
+        raise TokenError('The token has been revoked.')
+    return TokenUser(userid, permissions)
+
+def revoke(userid):
+    """
+    Revoke all the tokens issued to the user so far.
+    Returns the user's new key version.
+    """
+    key, created = TokenKey.objects.get_or_create(user_id=userid)
+    TokenKey.objects.filter(user_id=userid).update(version=F('version') + 1)
+    with _lock:
+        _versions.pop(userid, None)
+    return key.version + 1
+
+def api_auth(*permissions):
+    """
+    Decorator for API views that require a user with the permissions,
+    authorised by a bearer token or else by the session. Requests with a
+    bad token get a 401 response and those whose token lacks one of the
+    permissions a 403, in JSON.
+    """
+    def decorator(view):
+        if permissions:
+            session_view = login_required(permission_required(list(permissions))(view))
+        else:
+            session_view = login_required(view)
+
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            header = request.META.get('HTTP_AUTHORIZATION', '')
+            if header.startswith('Bearer '):
+                try:
+                    user = verify(header[len('Bearer '):].strip())
+                except TokenError as e:
+                    response = JsonResponse({ 'error': str(e) }, status=401)
+                    response['WWW-Authenticate'] = 'Bearer'
+                    return response
+                if not user.has_perms(permissions):
+                    return JsonResponse({ 'error': 'The token does not grant this operation.' }, status=403)
+                request.user = user
+                return view(request, *args, **kwargs)
+            # The view is exempt from the middleware's check, so make it here.
+            rejected = CsrfViewMiddleware().process_view(request, None, (), {})
+            if rejected is not None:
+                return rejected
+            return session_view(request, *args, **kwargs)
+        wrapped.csrf_exempt = True
+        return wrapped
+    return decorator
@@ -0,0 +1,207 @@
+"""
+Streaming export and import of menu trees.
+
+Two formats are supported:
+
+    ndjson   One JSON object per line, parents before their children:
+             {"id": 2, "parent": 1, "ordinal": 1, "name": "Starters", "data": ""}
+    outline  One name per line, indented four spaces per level.
+             Only the names are kept, so use ndjson for an exact copy.
+
+Exports stream the pre-order rows of the subtree straight from the database.
+Imports read their input line by line, keeping only the open ancestors of
+the current item, and insert the items in bulk_create batches inside one
+transaction, journalling each batch as one import change. The imported
+items get new ids; the ids, parents and ordinals of an ndjson file only
+describe its shape.
+"""
+
+from django.db import transaction
+from django.utils import six
+
+import json
+import logging
+
+from app.models import Menu, Submenu
+import app.api_impl as api
+import app.journal as journal
+
+logger = logging.getLogger(__name__)
+
+# Menu items inserted per bulk_create batch by import_tree.
+IMPORT_BATCH_SIZE = 1000
+
+OUTLINE_INDENT = '    '
+
+# The columns of the (id, parent_id, ordinal, level, name, data) export rows.
+EXPORT_COLUMNS = 'subtree.id, subtree.parent_id, subtree.ordinal, subtree.level, m.name, m.data'
+
+def export_rows(id, depth=-1, size=1000):
+    """
+    Yields the (id, parent_id, ordinal, level, name, data) rows of the
+    subtree rooted at id in pre-order, size rows at a time.
+    """
+    return api.iter_subtree(id, depth, size, columns=EXPORT_COLUMNS)
+
+def ndjson_lines(rows, include_root=True):
+    """
+    Yields the export rows as ndjson lines.
+    """
+    for id, parentid, ordinal, level, name, data in rows:
+        if level == 0 and not include_root:
+            continue
+        yield '{{"id": {0}, "parent": {1}, "ordinal": {2}, "name": {3}, "data": {4}}}\n'.format(
+            id, json.dumps(parentid), ordinal, json.dumps(name), json.dumps(data))
+
+def outline_lines(rows, include_root=True):
+    """
+    Yields the export rows as indented outline lines.
+    """
+    offset = 0 if include_root else 1
+    for id, parentid, ordinal, level, name, data in rows:
+        if level < offset:
+            continue
+        yield '{0}{1}\n'.format(OUTLINE_INDENT * (level - offset), name)
+
+def ndjson_items(lines):
+    """
+    Yields the (level, name, data) items of ndjson lines, the top level items
+    at level 1. Items whose parent is the parent of the first item are top
+    level items; every other item must follow its parent's line or one of
+    its parent's descendants' lines.
+    Raises MenuTreeError if a line is malformed or out of order.
+    """
+    # The file ids of the open ancestors of the next item, top level first.
+    ancestors = []
+    top = None
+    first = True
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            id, parent, name, data = record['id'], record['parent'], record['name'], record.get('data', '')
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise api.MenuTreeError('Line {0}: expected an object with id, parent and name.'.format(number))
+        if not isinstance(data, six.string_types):
+            raise api.MenuTreeError('Line {0}: data must be a string.'.format(number))
+        if first:
+            top = parent
+            first = False
+        if parent == top:
+            del ancestors[:]
+        else:
+            while ancestors and ancestors[-1] != parent:
+                ancestors.pop()
+            if not ancestors:
+                raise api.MenuTreeError('Line {0}: the parent {1} of item {2} has not been seen.'.format(number, parent, id))
+        ancestors.append(id)
+        yield len(ancestors), name, data
+
+def outline_items(lines):
+    """
+    Yields the (level, name, data) items of indented outline lines,
+    the top level items at level 1.
+    Raises MenuTreeError if the indentation is inconsistent.
+    """
+    level = 0
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n').expandtabs(len(OUTLINE_INDENT))
+        name = line.lstrip(' ')
+        if not name.strip():
+            continue
+        indent = len(line) - len(name)
+        if indent % len(OUTLINE_INDENT) or indent // len(OUTLINE_INDENT) > level:
+            raise api.MenuTreeError('Line {0}: unexpected indentation.'.format(number))
+        level = indent // len(OUTLINE_INDENT) + 1
+        yield level, name, ''
+
+# name: (export lines, import items, content type)
+FORMATS = {
+    'ndjson': (ndjson_lines, ndjson_items, 'application/x-ndjson'),
+    'outline': (outline_lines, outline_items, 'text/plain; charset=utf-8'),
+    }
+
+class ImportNode(object):
+    """
+    A menu item being imported, kept until its Submenu has been written
+    and for as long as it is an open ancestor.
+    """
+    __slots__ = ('menu', 'parent', 'path', 'depth', 'ordinal', 'lastordinal')
+
+    def __init__(self, menu, parent, depth, ordinal, path=None, lastordinal=0):
+        self.menu = menu
+        self.parent = parent
+        self.depth = depth
+        self.ordinal = ordinal
+        self.path = path
+        self.lastordinal = lastordinal
+
+def import_tree(parentid, items, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Adds the (level, name, data) items, in pre-order, beneath the menu parentid
+    in one transaction and returns the number of items added.
+    Raises MenuTreeError if an item is malformed or nested too deeply,
+    and Menu.DoesNotExist if there is no menu parentid.
+    """
+    id = int(parentid)
+    parentmenu = Menu.objects.get(id=id)
+    parentpath, parentdepth = api.menu_path(id)
+    gap = api.ordinal_gap()
+    count = 0
+    toplevel = 0
+    # The counts gained by new items written before all their descendants were read.
+    children = {}
+    descendants = {}
+
+    def flush(batch):
+        api.bulk_create_menus([node.menu for node in batch])
+        submenus = []
+        for node in batch:
+            # Parents precede their children, so every parent has its path.
+            node.path = '{0}{1}/'.format(node.parent.path, node.menu.id)
+            submenus.append(Submenu(parent_id=node.parent.menu.id, child_id=node.menu.id,
+                                    ordinal=node.ordinal, path=node.path, depth=node.depth))
+        Submenu.objects.bulk_create(submenus)
+        journal.record('import', items=[[node.menu.id, node.parent.menu.id, node.ordinal, node.menu.name] for node in batch])
+        del batch[:]
+
+    with transaction.atomic():
+        root = ImportNode(parentmenu, None, parentdepth, 0, path=parentpath, lastordinal=api.next_ordinal(id) - gap)
+        # ancestors[level] is the open ancestor at that level, the root at 0.
+        ancestors = [root]
+        batch = []
+        for level, name, data in items:
+            api.check_menu_name(name)
+            if not 0 < level <= len(ancestors):
+                raise api.MenuTreeError('Item {0!r} skips a level.'.format(name))
+            if parentdepth + level >= api.MAX_MENU_DEPTH:
+                raise api.MenuTreeError('Menus cannot be nested more than {0} levels deep.'.format(api.MAX_MENU_DEPTH))
+            del ancestors[level:]
+            parent = ancestors[-1]
+            parent.lastordinal += gap
+            # Count the item in its new ancestors, directly if they are unwritten.
+            for ancestor in ancestors[1:]:
+                direct = 1 if ancestor is parent else 0
+                if ancestor.menu.id is None:
+                    ancestor.menu.child_count += direct
+                    ancestor.menu.descendant_count += 1
+                else:
+                    children[ancestor.menu.id] = children.get(ancestor.menu.id, 0) + direct
+                    descendants[ancestor.menu.id] = descendants.get(ancestor.menu.id, 0) + 1
+            if level == 1:
+                toplevel += 1
+            node = ImportNode(Menu(name=name, data=data), parent, parentdepth + level, parent.lastordinal)
+            ancestors.append(node)
+            batch.append(node)
+            count += 1
+            if len(batch) >= batch_size:
+                flush(batch)
+        if batch:
+            flush(batch)
+        if count:
+            api.add_counts(parentpath, toplevel, count)
+            api.apply_counts(children, descendants)
+            api.tree_changed(id)
+    logger.info("transfer.import_tree(parentid={0}) added {1} items".format(id, count))
+    return count
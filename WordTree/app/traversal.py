@@ -0,0 +1,57 @@
+"""
+Iterative tree traversal.
+
+All the tree walks share walk(), which keeps an explicit stack (or queue)
+rather than recursing once per level, so degenerate deep trees cannot hit
+the Python recursion limit.
+"""
+
+from collections import deque
+
+PREORDER = 'pre'
+POSTORDER = 'post'
+LEVELORDER = 'level'
+
+def walk(root, children, order=PREORDER, depth=-1, enter=None, leave=None):
+    """
+    Traverse the tree beneath root, yielding (node, parent, level) triples.
+    The root has parent None and level 0.
+
+    children: function returning the ordered children of a node.
+    order: PREORDER, POSTORDER or LEVELORDER.
+    depth: -1 == all, 0 == root only, N>0 == N levels of child nodes
+    enter: optional callback(node, parent, level), called when a node is reached.
+    leave: optional callback(node, parent, level), called once all of a node's
+        descendants have been visited. Only used by the depth first orders.
+    """
+    if order == LEVELORDER:
+        pending = deque([(root, None, 0)])
+        while pending:
+            node, parent, level = pending.popleft()
+            if enter:
+                enter(node, parent, level)
+            yield node, parent, level
+            if depth < 0 or level < depth:
+                pending.extend((child, node, level + 1) for child in children(node))
+        return
+
+    if order not in (PREORDER, POSTORDER):
+        raise ValueError("Unknown traversal order: '{0}'".format(order))
+
+    # Each entry is reached once on the way down and once on the way back up.
+    pending = [(root, None, 0, False)]
+    while pending:
+        node, parent, level, done = pending.pop()
+        if done:
+            if leave:
+                leave(node, parent, level)
+            if order == POSTORDER:
+                yield node, parent, level
+            continue
+        if enter:
+            enter(node, parent, level)
+        if order == PREORDER:
+            yield node, parent, level
+        pending.append((node, parent, level, True))
+        if depth < 0 or level < depth:
+            pending.extend((child, node, level + 1, False) for child in reversed(list(children(node))))
@@ -1,6 +1,7 @@
 """
 Definition of views.
 """
+from django.conf import settings
 from django.contrib.auth.decorators import login_required, permission_required
 from django.shortcuts import render, redirect
 from django.http import HttpRequest, Http404
@@ -13,6 +14,7 @@ from datetime import datetime
 from app.models import Menu, Submenu
 from app.forms import AddMenu, EditMenu, ChangeParent
 import app.api_impl as api
+import app.journal as journal
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
@@ -91,7 +93,6 @@ def menu(request, menu):
     try:
         # Retrieve the last menu id in the URL fragment.
         menupath = menu.split("/")[0:-1] if menu else ['1']
-        depth = len(menupath)
         menuid = menupath[-1]
         chosenid = int(menuid)
         # Retrieve the corresponding Menu object.
@@ -105,7 +106,9 @@ def menu(request, menu):
             # Initialise the root menu given that it doesn't exist yet
             try:
                 rootmenu = Menu(name='RU App', data='')
-                rootmenu.save()
+                with transaction.atomic():
+                    rootmenu.save()
+                    journal.record('add', id=rootmenu.id, parent=None, ordinal=0, name=rootmenu.name)
                 chosenmenu = rootmenu
 
             except IntegrityError:
@@ -113,8 +116,17 @@ def menu(request, menu):
         else:
             raise Http404("Invalid menu: '" + menu + "'")
 
-    # and its children
-    children = api.gather_children(parentid=chosenmenu.id)
+    # The number of levels shown, counting the root menu as 1.
+    depth = api.menu_path(chosenmenu.id)[1] + 1
+
+    # and a page of its children
+    after = request.GET.get('after')
+    try:
+        after = api.decode_cursor(after) if after else None
+    except ValueError:
+        raise Http404("Invalid page: '" + request.GET.get('after') + "'")
+    children, next = api.current_children_page(parentid=chosenmenu.id, after=after,
+        limit=getattr(settings, 'MENU_PAGE_SIZE', api.CHILDREN_PAGE_SIZE))
 
     # Package the results in the appropriate structures
     return render_app_page(
@@ -126,8 +138,10 @@ def menu(request, menu):
                 'menu' : chosenmenu.name,
                 'parent' : '/'.join(menupath[0:-1]),
                 'depth' : depth,
+                'max_depth' : api.MAX_MENU_DEPTH,
                 'children' : children,
-                'last' : api.initialise_ordinals(children),
+                'after' : after,
+                'next' : next,
                 'order' : range(len(children))
             })
         )
@@ -142,9 +156,12 @@ def menu_add(request, menu):
         # create a form instance and populate it with data from the request
         form = AddMenu(request.POST)
         if form.is_valid():
-            # discard the new id response here and redirect
-            api.menu_add(parentid=form.cleaned_data['parent'], new_name=form.cleaned_data['name'])
-            return redirect('/menu/{0}/'.format(form.cleaned_data['next']))
+            try:
+                # discard the new id response here and redirect
+                api.menu_add(parentid=form.cleaned_data['parent'], new_name=form.cleaned_data['name'])
+                return redirect('/menu/{0}/'.format(form.cleaned_data['next']))
+            except api.MenuTreeError as e:
+                form.add_error(None, str(e))
     else:
         # Retrieve the matching parent menu id being added to.
         menupath = menu.split("/")[0:-1] if menu else ['1']
@@ -176,7 +193,10 @@ def menu_edit(request, menu):
             chosenid = form.cleaned_data['id']
             chosenmenu = Menu.objects.get(id=int(chosenid))
             chosenmenu.name = form.cleaned_data['name']
-            chosenmenu.save()
+            with transaction.atomic():
+                chosenmenu.save()
+                journal.record('edit', id=chosenmenu.id, name=chosenmenu.name)
+                api.tree_changed(chosenmenu.id)
 
             return redirect('/menu/{0}/'.format(form.cleaned_data['next']))
     else:
@@ -234,73 +254,44 @@ def menu_delete(request, menu):
     except ValueError:
         raise Http404("No menu matching: " + request.get_raw_uri() + "menu: " + menu)
 
-    except Menu.DoesNotExist:
+    except (Menu.DoesNotExist, Submenu.DoesNotExist):
         raise Http404("Invalid menu: '" + menu)
 
     # and delete all its descendants
-    descendants = api.gather_all_descendants(chosenid=menuid, postorder=True)
-    descendants.append(api.ChildMenu(id=menuid, name=chosenmenu.name, data=chosenmenu.data, parentid=parentid))
-
-    with transaction.atomic():
-        for descendant in descendants:
-            # First find the parent Menu
-            parentmenu = Menu.objects.get(id=descendant.parentid)
-            # Select the matching Submenu record.
-            submenu = Submenu.objects.get(child_id=descendant.id)
-            # There should only be one.
-            logger.info('Deleting Submenu: parent:{0} id:{1}'.format(parentmenu.id, submenu.child.id))
-            submenu.delete()
-            # Select the matching Menu record for that child.
-            themenu = Menu.objects.get(id=descendant.id)
-            logger.info('Deleting Menu: {0} {1}'.format(themenu.id, themenu.name))
-            # Again there ought to be only one.
-            themenu.delete()
-
-        # Adjust ordinals of the parent's children.
-        api.initialise_ordinals_of(parentid, startat=chosensubmenu.ordinal)
+    api.delete_subtree(chosensubmenu)
 
     return redirect('/menu/{0}/'.format('/'.join(menupath[0:-1])))
 
 
-@login_required
-@permission_required(['app.change_menu', 'app.change_submenu'])
-def move_next(request, menu):
+def move_child(menu, step):
     """
-    Swap given menu item with next one in the parent menu's children.
-    If at end, do nothing.
+    Move the last menu in the path step places among its siblings.
     Redisplay parent menu.
     """
-    menupath = menu.split("/")[0:-1]
+    menupath = menu.split("/")[0:-1] if menu else ['1']
     if len(menupath) > 1:
-        # get the ordering right
-        children = api.gather_children(int(menupath[-2]))
-        last = api.initialise_ordinals(children)
-        # iterate over the list and find a match for menupath[-1].
-        next = 0
+        try:
+            submenu = Submenu.objects.get(child=int(menupath[-1]))
+        except Submenu.DoesNotExist:
+            raise Http404("Invalid menu: '" + menu)
         with transaction.atomic():
-            for child in children:
-                if child.id == int(menupath[-1]):
-                    submenu = Submenu.objects.get(child=child.id)
-                    # if it is already the last one do nothing.
-                    if submenu.ordinal == last:
-                        break
-                    else:
-                        next = submenu.ordinal + 1
-                        submenu.ordinal = next
-                        submenu.save()
-                elif next > 0:
-                    # the previous iteration matched the item to be moved down,
-                    # so change this next item's ordinal accordingly.
-                    submenu = Submenu.objects.get(child=child.id)
-                    submenu.ordinal = next - 1
-                    submenu.save()
-                    break
-
-            return redirect('/menu/{0}/'.format('/'.join(menupath[0:-1])))
+            api.move_child(submenu, step)
+            api.tree_changed(submenu.parent_id)
+        return redirect('/menu/{0}/'.format('/'.join(menupath[0:-1])))
     else:
         # cannot reposition the root menu.
         return redirect(menu)
 
+@login_required
+@permission_required(['app.change_menu', 'app.change_submenu'])
+def move_next(request, menu):
+    """
+    Swap given menu item with next one in the parent menu's children.
+    If at end, do nothing.
+    Redisplay parent menu.
+    """
+    return move_child(menu, 1)
+
 @login_required
 @permission_required(['app.change_menu', 'app.change_submenu'])
 def move_prev(request, menu):
@@ -309,40 +300,7 @@ def move_prev(request, menu):
     If at beginning, do nothing.
     Redisplay parent menu.
     """
-    menupath = menu.split("/")[0:-1] if menu else ['1']
-    if len(menupath) > 1:
-        # gather the children of this menu's parent.
-        children = api.gather_children(int(menupath[-2]))
-        # check the ordinal values and then initialise them if 0.
-        last = api.initialise_ordinals(children)
-        # iterate over the list and find a match for menupath[-1].
-        prev = 0
-        with transaction.atomic():
-            # traverse the child list backwards
-            # to preserve the move_next algorithm's pattern
-            # and to make it simpler to understand.
-            for child in reversed(children):
-                if child.id == int(menupath[-1]):
-                    submenu = Submenu.objects.get(child=child.id)
-                    # if it is already the first one do nothing.
-                    if submenu.ordinal == 1:
-                        break
-                    else:
-                        prev = submenu.ordinal - 1
-                        submenu.ordinal = prev
-                        submenu.save()
-                elif prev > 0:
-                    # the previous iteration matched the item to be moved up,
-                    # so change this next item's ordinal accordingly.
-                    submenu = Submenu.objects.get(child=child.id)
-                    submenu.ordinal = prev + 1
-                    submenu.save()
-                    break
-
-            return redirect('/menu/{0}/'.format('/'.join(menupath[0:-1])))
-    else:
-        # cannot reposition the root menu.
-        return redirect(menu)
+    return move_child(menu, -1)
 
 @login_required
 @permission_required(['app.change_submenu'])
@@ -359,24 +317,19 @@ def change_parent(request, menu):
         if form.is_valid():
             menuid = form.cleaned_data['id']
             parentid = form.cleaned_data['parentid']
-            with transaction.atomic():
-                submenu = Submenu.objects.get(child=int(menuid))
-                parent = Menu.objects.get(id=int(parentid))
-                # adjust ordinal to put this new item at the end.
-                ordinal = len(api.gather_children(parentid=parentid)) + 1
-                submenu.parent = parent
-                submenu.ordinal = ordinal
-                submenu.save()
-            # redirect to new parent menu.
             try:
-                ancestors = api.gather_ancestors(menuid=parent.id)
+                path = api.change_parent(menuid, parentid)
+            except api.MenuTreeError as e:
+                form.add_error(None, str(e))
+            except Menu.DoesNotExist:
+                form.add_error('parentid', 'There is no menu {0}.'.format(parentid))
             except Submenu.DoesNotExist:
                 raise Http404('Missing menu item')
-            parents = []
-            for ancestor in ancestors:
-                parents.append(str(ancestor.id))
-            target_fragment = '/menu/{0}/'.format('/'.join(parents))
-            return redirect(target_fragment)
+            else:
+                # redirect to new parent menu.
+                parents = [str(id) for id in api.path_ids(path)[:-1]]
+                target_fragment = '/menu/{0}/'.format('/'.join(parents))
+                return redirect(target_fragment)
     else:
         try:
             # Retrieve the matching menu id being edited.